@@ -0,0 +1,169 @@
+"""
+Benchmarks of the plugin hot paths.
+
+They are kept apart from the tests and are run explicitly, e.g.
+
+    ODA_ONTOLOGY_PATH=tests/oda-ontology.ttl python -m pytest benchmarks -s
+
+Every benchmark reports throughput, latency percentiles and peak traced memory.
+Results can be stored as a baseline with --bench-save and are compared
+to the stored baseline (benchmarks/baselines.json by default) on the next runs.
+"""
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+
+# the plugin reads its config on import, benchmarks should not depend on a local one
+_bench_plugin_conf = os.path.join(tempfile.mkdtemp(prefix='nb2w_bench_'), 'plugin_conf.yml')
+with open(_bench_plugin_conf, 'w') as fd:
+    fd.write('instruments: {}\n')
+os.environ.setdefault('CDCI_NB2W_PLUGIN_CONF_FILE', _bench_plugin_conf)
+
+default_baseline_file = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('nb2w-benchmarks')
+    group.addoption('--bench-rounds', type=int, default=20,
+                    help='number of measured rounds per benchmark')
+    group.addoption('--bench-size', type=int, default=10000,
+                    help='size scale of the synthetic products (rows, pixels per side x 10)')
+    group.addoption('--bench-baseline', default=default_baseline_file,
+                    help='baseline file to compare with / save to')
+    group.addoption('--bench-save', action='store_true', default=False,
+                    help='store the results as the new baseline')
+    group.addoption('--bench-tolerance', type=float, default=0.25,
+                    help='allowed relative slowdown / memory growth with respect to the baseline')
+    group.addoption('--bench-fail-on-regression', action='store_true', default=False,
+                    help='fail the benchmark if it regresses with respect to the baseline')
+
+
+class BenchResult:
+    def __init__(self, name, latencies, items, peak_memory):
+        self.name = name
+        self.latencies = np.array(latencies)
+        self.items = items
+        self.peak_memory = peak_memory
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q))
+
+    @property
+    def throughput(self):
+        return self.items * len(self.latencies) / self.latencies.sum()
+
+    def as_dict(self):
+        return {'rounds': len(self.latencies),
+                'throughput': self.throughput,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': float(self.latencies.max()),
+                'peak_memory': self.peak_memory}
+
+    def regressions(self, baseline, tolerance):
+        found = []
+        for key in ['p50', 'peak_memory']:
+            new, old = self.as_dict()[key], baseline.get(key)
+            if old and new > old * (1 + tolerance):
+                found.append(f'{key}: {new:.4g} vs baseline {old:.4g}')
+        return found
+
+
+class BenchRunner:
+    def __init__(self, config):
+        self.rounds = config.getoption('--bench-rounds')
+        self.tolerance = config.getoption('--bench-tolerance')
+        self.fail_on_regression = config.getoption('--bench-fail-on-regression')
+        self.baseline_file = config.getoption('--bench-baseline')
+        self.save = config.getoption('--bench-save')
+        self.results = {}
+        self.baseline = {}
+        if os.path.isfile(self.baseline_file):
+            with open(self.baseline_file) as fd:
+                self.baseline = json.load(fd)
+
+    def __call__(self, name, func, items=1, rounds=None, warmup=1):
+        rounds = rounds or self.rounds
+
+        for _ in range(warmup):
+            func()
+
+        latencies = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - t0)
+
+        # memory is traced in a separate round, tracing distorts the timing
+        tracemalloc.start()
+        try:
+            func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        result = BenchResult(name, latencies, items, peak_memory)
+        self.results[name] = result.as_dict()
+
+        if name in self.baseline:
+            regressions = result.regressions(self.baseline[name], self.tolerance)
+            if regressions:
+                self.results[name]['regressions'] = regressions
+                if self.fail_on_regression:
+                    pytest.fail(f'{name} regressed: ' + '; '.join(regressions))
+        return result
+
+    def report(self, terminalreporter):
+        terminalreporter.section('nb2workflow plugin benchmarks')
+        terminalreporter.write_line(f"{'benchmark':<48}{'items/s':>12}{'p50 ms':>10}{'p90 ms':>10}"
+                                    f"{'p99 ms':>10}{'peak MiB':>10}")
+        for name, res in self.results.items():
+            terminalreporter.write_line(f"{name:<48}{res['throughput']:>12.1f}{res['p50']*1e3:>10.2f}"
+                                        f"{res['p90']*1e3:>10.2f}{res['p99']*1e3:>10.2f}"
+                                        f"{res['peak_memory']/2**20:>10.2f}")
+            for reg in res.get('regressions', []):
+                terminalreporter.write_line(f'    REGRESSION {reg}')
+
+    def store(self):
+        if self.save and self.results:
+            baseline = dict(self.baseline)
+            baseline.update({k: {kk: vv for kk, vv in v.items() if kk != 'regressions'}
+                             for k, v in self.results.items()})
+            with open(self.baseline_file, 'w') as fd:
+                json.dump(baseline, fd, indent=4, sort_keys=True)
+
+
+def pytest_configure(config):
+    config._nb2w_bench = BenchRunner(config)
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    runner = getattr(config, '_nb2w_bench', None)
+    if runner is not None and runner.results:
+        runner.report(terminalreporter)
+        runner.store()
+
+
+@pytest.fixture
+def bench(request):
+    return request.config._nb2w_bench
+
+
+@pytest.fixture(scope='session')
+def bench_size(request):
+    return request.config.getoption('--bench-size')
+
+
+@pytest.fixture(scope='session')
+def ontology_path():
+    path = os.environ.get('ODA_ONTOLOGY_PATH', 'tests/oda-ontology.ttl')
+    if '://' not in path and not os.path.isfile(path):
+        pytest.skip(f'ontology file {path} is not available')
+    return path
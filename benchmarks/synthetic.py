@@ -0,0 +1,152 @@
+"""
+Synthetic nb2workflow backend descriptions and outputs of configurable size.
+"""
+
+import io
+import json
+
+import numpy as np
+from astropy.table import Table
+from oda_api.data_products import (NumpyDataProduct,
+                                   NumpyDataUnit,
+                                   ODAAstropyTable,
+                                   BinaryProduct,
+                                   PictureProduct)
+
+onto = 'http://odahub.io/ontology#'
+
+parameter_types = [
+    ('Integer', 10),
+    ('Float', 1.5),
+    ('String', 'spam'),
+    ('Energy_keV', 20.),
+    ('Angle', 1.2),
+]
+
+source_parameters = {
+    'start_time': ('StartTime', '2021-06-25T05:59:37.000'),
+    'end_time': ('EndTime', '2021-06-25T06:59:37.000'),
+    'poi_ra': ('PointOfInterestRA', 83.63),
+    'poi_dec': ('PointOfInterestDEC', 22.01),
+    'src_name': ('AstrophysicalObject', 'Crab'),
+}
+
+output_types = {
+    'lightcurve': 'LightCurve',
+    'image': 'Image',
+    'table': 'ODAAstropyTable',
+    'picture': 'ODAPictureProduct',
+    'binary': 'ODABinaryProduct',
+    'text': 'ODATextProduct',
+    'number': 'Integer',
+}
+
+
+def _description(name, owl_type, value):
+    return {'comment': '',
+            'default_value': value,
+            'name': name,
+            'owl_type': onto + owl_type,
+            'python_type': {'type_object': f"<class '{type(value).__name__}'>"},
+            'value': value}
+
+
+def parameters_description(n_params, with_source=True):
+    descr = {}
+    if with_source:
+        for name, (owl_type, value) in source_parameters.items():
+            descr[name] = _description(name, owl_type, value)
+    for i in range(n_params):
+        owl_type, value = parameter_types[i % len(parameter_types)]
+        name = f'par_{owl_type.lower()}_{i}'
+        descr[name] = _description(name, owl_type, value)
+    return descr
+
+
+def output_description(kinds=tuple(output_types)):
+    return {kind: _description(kind, output_types[kind], '') for kind in kinds}
+
+
+def backend_options(n_products=5, n_params=20, kinds=tuple(output_types)):
+    return {f'product_{i}': {'parameters': parameters_description(n_params),
+                             'output': output_description(kinds)}
+            for i in range(n_products)}
+
+
+def lightcurve_output(n_rows):
+    data = np.zeros(n_rows, dtype=[('TIME', '<f8'), ('RATE', '<f8'), ('ERROR', '<f8'), ('TIMEDEL', '<f8')])
+    data['TIME'] = np.linspace(0, 1000, n_rows)
+    data['RATE'] = np.random.normal(100, 10, n_rows)
+    data['ERROR'] = 10.
+    data['TIMEDEL'] = 1000. / n_rows
+    units = [NumpyDataUnit(data=None, hdu_type='primary', name='PRIMARY'),
+             NumpyDataUnit(data=data, hdu_type='bintable', name='RATE',
+                           units_dict={'TIME': 'd', 'RATE': 'ct/s', 'ERROR': 'ct/s'})]
+    return NumpyDataProduct(units, name='lightcurve').encode()
+
+
+def image_output(side):
+    units = [NumpyDataUnit(data=np.random.random((side, side)).astype('float32'),
+                           data_header={'BUNIT': 'ct'},
+                           hdu_type='primary', name='PRIMARY')]
+    return NumpyDataProduct(units, name='image').encode()
+
+
+def table_output(n_rows):
+    tab = Table({'energy': np.linspace(1, 100, n_rows),
+                 'flux': np.random.random(n_rows),
+                 'name': [f'src{i}' for i in range(n_rows)]})
+    return ODAAstropyTable(tab, name='table').encode()
+
+
+def picture_output(side):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    plt.imshow(np.random.random((side, side)))
+    with io.BytesIO() as buf:
+        fig.savefig(buf, format='png')
+        png_data = buf.getvalue()
+    plt.close(fig)
+    return PictureProduct(png_data, name='picture').encode()
+
+
+def binary_output(size):
+    return BinaryProduct(np.random.bytes(size), name='binary').encode()
+
+
+def outputs(size, kinds=tuple(output_types)):
+    makers = {
+        'lightcurve': lambda: lightcurve_output(size),
+        'image': lambda: image_output(max(size // 10, 16)),
+        'table': lambda: table_output(size),
+        'picture': lambda: picture_output(max(size // 20, 16)),
+        'binary': lambda: binary_output(size * 10),
+        'text': lambda: 'x' * size,
+        'number': lambda: 42,
+    }
+    return {kind: makers[kind]() for kind in kinds}
+
+
+def backend_response(size, kinds=tuple(output_types), jobdir='/tmp/nb2w-bench'):
+    return {'exceptions': [],
+            'jobdir': jobdir,
+            'output': outputs(size, kinds)}
+
+
+def backend_async_response(size, kinds=tuple(output_types), jobdir='/tmp/nb2w-bench'):
+    return {'workflow_status': 'done',
+            'comment': '',
+            'data': backend_response(size, kinds, jobdir)}
+
+
+def response_from_json(json_data, content_type='application/json'):
+    import requests
+
+    res = requests.models.Response()
+    res.status_code = 200
+    res.headers['content-type'] = content_type
+    res._content = json.dumps(json_data).encode() if content_type == 'application/json' else json_data.encode()
+    return res
@@ -0,0 +1,182 @@
+import os
+
+import pytest
+from werkzeug.wrappers import Response
+
+from . import synthetic
+
+product_kinds = list(synthetic.output_types)
+
+
+@pytest.fixture
+def out_dir(tmp_path):
+    return str(tmp_path)
+
+
+@pytest.fixture
+def bench_dispatcher(httpserver):
+    from cdci_data_analysis.configurer import DataServerConf
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    config = DataServerConf.from_conf_dict({'data_server_url': httpserver.url_for('/'),
+                                            'dummy_cache': ''})
+    return NB2WDataDispatcher(instrument='bench', config=config)
+
+
+@pytest.mark.parametrize('n_params', [10, 100])
+def test_construct_parameter_lists(bench, ontology_path, n_params):
+    from dispatcher_plugin_nb2workflow.queries import construct_parameter_lists
+
+    descr = synthetic.parameters_description(n_params)
+
+    def run():
+        construct_parameter_lists.__wrapped__.cache_clear()
+        construct_parameter_lists(bk_descript_dict=descr, ontology_path=ontology_path)
+
+    bench(f'construct_parameter_lists[{n_params}]', run, items=n_params, rounds=5)
+
+
+@pytest.mark.parametrize('n_products', [5, 50])
+def test_query_list_and_dict_factory(bench, ontology_path, n_products):
+    from dispatcher_plugin_nb2workflow.queries import NB2WProductQuery, NB2WSourceQuery
+
+    options = synthetic.backend_options(n_products=n_products, n_params=20)
+
+    def run():
+        NB2WProductQuery.query_list_and_dict_factory(options, ontology_path)
+        NB2WSourceQuery.from_backend_options(options, ontology_path)
+
+    bench(f'query_list_and_dict_factory[{n_products}]', run, items=n_products)
+
+
+@pytest.mark.parametrize('kind', product_kinds)
+def test_prod_list_factory(bench, bench_size, ontology_path, out_dir, kind):
+    from dispatcher_plugin_nb2workflow.products import NB2WProduct
+
+    descr = synthetic.output_description([kind])
+    output = synthetic.outputs(bench_size, [kind])
+
+    bench(f'prod_list_factory[{kind}]',
+          lambda: NB2WProduct.prod_list_factory(descr, output, out_dir, ontology_path))
+
+
+@pytest.mark.parametrize('kind', product_kinds)
+def test_get_html_draw(bench, bench_size, ontology_path, out_dir, kind):
+    from dispatcher_plugin_nb2workflow.products import NB2WProduct
+
+    descr = synthetic.output_description([kind])
+    output = synthetic.outputs(bench_size, [kind])
+    product = NB2WProduct.prod_list_factory(descr, output, out_dir, ontology_path)[0]
+
+    bench(f'get_html_draw[{kind}]', product.get_html_draw, rounds=5)
+
+
+def test_build_product_list(bench, bench_size, ontology_path, out_dir):
+    from dispatcher_plugin_nb2workflow.queries import NB2WProductQuery
+
+    query = NB2WProductQuery('bench_query',
+                             'bench',
+                             synthetic.parameters_description(10),
+                             synthetic.output_description(),
+                             ontology_path)
+    res = synthetic.response_from_json(synthetic.backend_response(bench_size))
+
+    bench('build_product_list',
+          lambda: query.build_product_list(None, res, out_dir),
+          items=len(product_kinds))
+
+
+def test_run_query_round_trip(bench, bench_size, ontology_path, out_dir, httpserver, bench_dispatcher):
+    from dispatcher_plugin_nb2workflow.queries import NB2WProductQuery
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/bench').respond_with_json(synthetic.backend_response(bench_size))
+
+    query = NB2WProductQuery('bench_query',
+                             'bench',
+                             synthetic.parameters_description(10),
+                             synthetic.output_description(),
+                             ontology_path)
+
+    def run():
+        res, query_out = bench_dispatcher.run_query(run_asynch=False, task='bench', param_dict={'par': 1})
+        assert query_out.status_dictionary['status'] == 0
+        query.build_product_list(None, res, out_dir)
+
+    bench('run_query_round_trip', run, items=len(product_kinds))
+
+
+def test_get_progress_run_round_trip(bench, httpserver, bench_dispatcher):
+    trace_path = os.path.join(os.path.dirname(__file__), '..', 'tests', 'responses', 'test_output.html')
+    with open(trace_path) as fd:
+        trace_html = fd.read()
+
+    httpserver.expect_request('/api/v1.0/get/bench').respond_with_json(
+        {'workflow_status': 'started', 'comment': '', 'jobdir': '/tmp/nb2w-bench'})
+    httpserver.expect_request('/trace/nb2w-bench/bench').respond_with_response(
+        Response(trace_html, status=200, content_type='text/html'))
+
+    def run():
+        res_trace_dict, query_out = bench_dispatcher.get_progress_run(run_asynch=True,
+                                                                      call_back_url='http://localhost/callback',
+                                                                      task='bench',
+                                                                      param_dict={'par': 1})
+        assert res_trace_dict is not None
+
+    bench('get_progress_run_round_trip', run)
+
+
+@pytest.mark.parametrize('n_params', [10, 100, 500])
+def test_backend_param_dict_from_instrument(bench, ontology_path, n_params):
+    from cdci_data_analysis.analysis.instrument import Instrument
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+    from dispatcher_plugin_nb2workflow.queries import NB2WInstrumentQuery, NB2WProductQuery, NB2WSourceQuery
+
+    options = synthetic.backend_options(n_products=3, n_params=n_params)
+    query_list, query_dict = NB2WProductQuery.query_list_and_dict_factory(options, ontology_path)
+    instrument = Instrument('bench',
+                            src_query=NB2WSourceQuery.from_backend_options(options, ontology_path),
+                            instrumet_query=NB2WInstrumentQuery('instr_query', False),
+                            data_serve_conf_file=None,
+                            product_queries_list=query_list,
+                            query_dictionary=query_dict,
+                            asynch=True,
+                            data_server_query_class=NB2WDataDispatcher)
+    query = query_list[0]
+
+    def legacy():
+        # the per-name lookup through the instrument, for reference
+        param_dict = {}
+        for param_name in instrument.get_parameters_name_list(prod_name=query.backend_product_name):
+            param_instance = instrument.get_par_by_name(param_name, prod_name=query.backend_product_name)
+            bk_pname = query.par_name_substitution.get(param_name, param_name)
+            if bk_pname.startswith('_') or bk_pname in query.backend_param_dict:
+                param_dict[bk_pname] = param_instance.get_default_value()
+        return param_dict
+
+    assert query.backend_param_dict_from_instrument(instrument) == legacy()
+
+    bench(f'backend_param_dict_legacy[{n_params}]', legacy, items=n_params, rounds=5)
+    bench(f'backend_param_dict_from_instrument[{n_params}]',
+          lambda: query.backend_param_dict_from_instrument(instrument),
+          items=n_params)
+
+
+@pytest.mark.parametrize('kind', ['lightcurve', 'image'])
+def test_decode_numpy_data_product(bench, bench_size, kind):
+    import numpy as np
+    from oda_api.data_products import NumpyDataProduct
+    from dispatcher_plugin_nb2workflow import decoding
+    from dispatcher_plugin_nb2workflow.decoding import decode_numpy_data_product
+
+    encoded = synthetic.outputs(bench_size * 10, kinds=[kind])[kind]
+
+    decoded = decode_numpy_data_product(encoded)
+    for du, ref_du in zip(decoded.data_unit, NumpyDataProduct.decode(encoded).data_unit):
+        assert du.data is None and ref_du.data is None or np.array_equal(du.data, ref_du.data)
+
+    legacy = bench(f'numpy_decode_legacy[{kind}]', lambda: NumpyDataProduct.decode(encoded), rounds=5)
+    streamed = bench(f'numpy_decode_streamed[{kind}]', lambda: decode_numpy_data_product(encoded), rounds=5)
+    # the legacy decoding holds the whole decoded payload and the arrays together
+    if sum(len(du['binarys'] or '') for du in encoded['data_unit_list']) > 4 * decoding.chunk_size:
+        assert streamed.peak_memory < legacy.peak_memory
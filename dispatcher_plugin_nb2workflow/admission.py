@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BackendBusy(RuntimeError):
+    pass
+
+
+class AdmissionController:
+    """
+    Limits the number of concurrent requests sent to one backend.
+
+    Requests above max_concurrent_requests wait in a queue of at most max_queued_requests,
+    for at most queue_timeout seconds. BackendBusy is raised when the queue is full
+    or the wait times out. A limit of None means unlimited.
+    One more slot is reserved for the requests which the queries depend on (the backend options),
+    so that they do not fail behind the product requests.
+    The limits are counted in the process, so they apply to each dispatcher worker.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.max_concurrent_requests = None
+        self.max_queued_requests = None
+        self.queue_timeout = 30
+        self.active = 0
+        self.reserved_active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def configure(self, max_concurrent_requests=None, max_queued_requests=None, queue_timeout=30):
+        with self._cond:
+            self.max_concurrent_requests = max_concurrent_requests
+            self.max_queued_requests = max_queued_requests
+            self.queue_timeout = queue_timeout
+            self._cond.notify_all()
+
+    def _has_free_slot(self):
+        return self.max_concurrent_requests is None or self.active < self.max_concurrent_requests
+
+    def _can_enter(self, reserved):
+        return self._has_free_slot() or (reserved and not self.reserved_active)
+
+    @contextmanager
+    def slot(self, reserved=False):
+        t0 = time.perf_counter()
+        with self._cond:
+            if not self._can_enter(reserved):
+                if (not reserved and self.max_queued_requests is not None 
+                    and self.waiting >= self.max_queued_requests):
+                    metrics.inc('admission_rejected', instrument=self.name, reason='queue_full')
+                    raise BackendBusy(f'Backend of {self.name} is busy: {self.active} requests running '
+                                      f'and {self.waiting} waiting')
+                self.waiting += 1
+                metrics.set_gauge('admission_queue_depth', self.waiting, instrument=self.name)
+                try:
+                    admitted = self._cond.wait_for(lambda: self._can_enter(reserved), timeout=self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+                    metrics.set_gauge('admission_queue_depth', self.waiting, instrument=self.name)
+                if not admitted:
+                    metrics.inc('admission_rejected', instrument=self.name, reason='timeout')
+                    raise BackendBusy(f'Backend of {self.name} is busy: no request slot '
+                                      f'within {self.queue_timeout} s')
+            use_reserved = not self._has_free_slot()
+            if use_reserved:
+                self.reserved_active += 1
+            else:
+                self.active += 1
+                metrics.set_gauge('admission_active_requests', self.active, instrument=self.name)
+        metrics.observe('admission_wait', time.perf_counter() - t0, instrument=self.name)
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                if use_reserved:
+                    self.reserved_active -= 1
+                    # only the waiting reserved requests can take it
+                    self._cond.notify_all()
+                else:
+                    self.active -= 1
+                    metrics.set_gauge('admission_active_requests', self.active, instrument=self.name)
+                    self._cond.notify()
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def get_admission_controller(instr_name):
+    from .exposer import get_instrument_option
+
+    with _controllers_lock:
+        controller = _controllers.get(instr_name)
+        if controller is None:
+            controller = _controllers[instr_name] = AdmissionController(instr_name)
+    # the limits follow the current config, which may be reloaded
+    limits = (get_instrument_option(instr_name, 'max_concurrent_requests'),
+              get_instrument_option(instr_name, 'max_queued_requests'),
+              get_instrument_option(instr_name, 'queue_timeout', 30))
+    if limits != (controller.max_concurrent_requests, controller.max_queued_requests, controller.queue_timeout):
+        controller.configure(*limits)
+    return controller
@@ -0,0 +1,106 @@
+import gzip
+import logging
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingArchive:
+    """
+    Gzipped tar archive of the product files, built while the products are written.
+
+    Each file is added right after it is written, while it is still in the page cache.
+    The tar stream is cut in blocks which are compressed in parallel as separate gzip members
+    (as pigz does), their concatenation being a valid gzip file. The archive is written
+    to a temporary name, and renamed when it is complete.
+    """
+    def __init__(self, path, arcdir, threads=None, compresslevel=6, block_size=4 << 20):
+        self.path = path
+        self.arcdir = arcdir
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.threads = threads or min(4, os.cpu_count() or 1)
+        self._file = atomic_write(path)
+        self._fd = self._file.fd
+        self._pool = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._offset = 0
+        self.file_names = []
+
+    def _compress(self, block):
+        return gzip.compress(block, compresslevel=self.compresslevel, mtime=0)
+
+    def _submit(self, data):
+        self._buffer += data
+        self._offset += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._pending.append(self._pool.submit(self._compress, block))
+        # compressed blocks are written in order, keeping a bounded number in flight
+        while len(self._pending) > 2 * self.threads:
+            self._fd.write(self._pending.popleft().result())
+
+    def add(self, file_path):
+        info = tarfile.TarInfo(name=f'{self.arcdir}/{os.path.basename(file_path)}')
+        st = os.stat(file_path)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = 0o644
+        self._submit(info.tobuf(format=tarfile.PAX_FORMAT))
+        with open(file_path, 'rb') as fd:
+            while True:
+                chunk = fd.read(self.block_size)
+                if not chunk:
+                    break
+                self._submit(chunk)
+        if info.size % tarfile.BLOCKSIZE:
+            self._submit(tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE))
+        self.file_names.append(os.path.basename(file_path))
+
+    def close(self):
+        # end of archive, padded to a full record as tarfile does
+        end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        remainder = (self._offset + len(end)) % tarfile.RECORDSIZE
+        if remainder:
+            end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+        self._submit(end)
+        if self._buffer:
+            self._pending.append(self._pool.submit(self._compress, bytes(self._buffer)))
+            self._buffer = bytearray()
+        while self._pending:
+            self._fd.write(self._pending.popleft().result())
+        self._pool.shutdown()
+        self._file.commit()
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pool.shutdown()
+        self._file.discard()
+
+
+def open_download_archive(out_dir, download_file_name, archive_conf):
+    """
+    The archive of the products if it is enabled in archive_conf, None otherwise (the default).
+    The dispatcher does not read it yet: its download builds an archive of its own.
+    """
+    if not archive_conf or not archive_conf.get('enabled', False) or out_dir is None:
+        return None
+    # same layout as the archive made by the dispatcher on download
+    download_file_name = download_file_name.replace(' ', '_')
+    arcdir = download_file_name.replace('.tar', '').replace('.gz', '')
+    try:
+        return StreamingArchive(os.path.join(out_dir, download_file_name),
+                                arcdir,
+                                threads=archive_conf.get('threads'),
+                                compresslevel=archive_conf.get('compresslevel', 6))
+    except OSError as e:
+        logger.warning('Unable to create the download archive in %s: %s', out_dir, e)
+        return None
@@ -1,23 +1,65 @@
 from cdci_data_analysis.analysis.queries import QueryOutput
 from cdci_data_analysis.configurer import DataServerConf
 import requests
+import json
 import time 
 from . import exposer
+from .metrics import registry as metrics
+from .singleflight import group as singleflight_group, request_key
+from .admission import BackendBusy, get_admission_controller
+from .replicas import get_replica_pool
+from .shared_store import shared_store
+from .result_spool import result_spool
+from .util import response_json, compact_json_value
 from urllib.parse import urlsplit, parse_qs, urlencode
-import os
+import threading
 import logging
 
+try:
+    # lists gzip and deflate, plus br and zstd when the corresponding decoders are installed
+    from urllib3.util.request import ACCEPT_ENCODING
+except ImportError:
+    ACCEPT_ENCODING = 'gzip,deflate'
+
 logger = logging.getLogger()
 
+# instrument config keys used by the plugin, besides data_server_url and dummy_cache
+allowed_instrument_conf_keys = ['restricted_access', 
+                                'creativeWorkStatus', 
+                                'api_passthrough',
+                                'max_concurrent_requests',
+                                'max_queued_requests',
+                                'queue_timeout',
+                                'replica_routing',
+                                'replica_max_failures',
+                                'replica_health_check_interval',
+                                'table_format',
+                                'api_table_encoding',
+                                'fits_compression',
+                                'download_archive',
+                                'post_params_threshold',
+                                'result_spool',
+                                'progress_format',
+                                'progress_cells']
+
+# last options received from each backend, used when the backend is too busy to request them again
+_last_backend_options = {}
+_last_backend_options_lock = threading.Lock()
+
+
 class NB2WDataDispatcher:
     def __init__(self, instrument=None, param_dict=None, task=None, config=None):
         iname = instrument if isinstance(instrument, str) else instrument.name
         if config is None:
-            config = DataServerConf.from_conf_dict(exposer.combined_instrument_dict[iname],
-                                                   allowed_keys=['restricted_access', 'creativeWorkStatus'])
+            config = DataServerConf.from_conf_dict(exposer.get_combined_instrument_dict()[iname],
+                                                   allowed_keys=allowed_instrument_conf_keys)
 
+        self.instrument_name = iname
         self.include_glued_output = exposer.static_config_dict.get('include_glued_output', True)
-        self.data_server_url = config.data_server_url
+        self.compress_transfer = exposer.static_config_dict.get('compress_transfer', True)
+        # data_server_url may list several replicas of the backend
+        self.replicas = get_replica_pool(iname, config.data_server_url)
+        self.data_server_url = self.replicas.urls[0]
         self.task = task
         self.param_dict = param_dict
         
@@ -27,34 +69,124 @@ class NB2WDataDispatcher:
             parsed = urlsplit(products_url_config)
             if parsed.scheme and parsed.netloc:
                 self.external_disp_url = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
+
+    def _backend_get(self, path, params=None, endpoint='get', product=None, affinity_key=None, reserved=False):
+        # identical requests running at the same time share one backend call
+        key = request_key(self.instrument_name, path, params)
+        if affinity_key is None:
+            affinity_key = key
+        if (params or {}).get('_async_request') == 'yes':
+            # each async submission registers its own callback with the backend, so it is not merged
+            return self._admitted_fetch(path, params, endpoint, product, affinity_key)
+        res, executed = singleflight_group.do(key, lambda: self._admitted_fetch(path, params, endpoint, product, 
+                                                                                affinity_key, reserved))
+        if not executed:
+            metrics.inc('backend_coalesced', instrument=self.instrument_name, endpoint=endpoint)
+        return res
+
+    def _admitted_fetch(self, path, params=None, endpoint='get', product=None, affinity_key=None, reserved=False):
+        # raises BackendBusy if the instrument backend has no free request slot in time
+        with get_admission_controller(self.instrument_name).slot(reserved=reserved):
+            return self._routed_fetch(path, params, endpoint, product, affinity_key)
+
+    def _routed_fetch(self, path, params=None, endpoint='get', product=None, affinity_key=None):
+        failed_replicas = []
+        while True:
+            replica = self.replicas.choose(affinity_key)
+            if replica in failed_replicas:
+                raise failed_replicas_error
+            with self.replicas.outstanding(replica):
+                try:
+                    res = self._backend_fetch(replica.url + '/' + path, params, endpoint, product)
+                    break
+                except requests.ConnectionError as e:
+                    # the request did not reach the backend, another replica can take it
+                    self.replicas.mark_failure(replica)
+                    failed_replicas.append(replica)
+                    failed_replicas_error = e
+        if res.status_code in [502, 503, 504]:
+            self.replicas.mark_failure(replica)
+        else:
+            self.replicas.mark_success(replica)
+            # the job (if any) is now owned by this replica
+            self.replicas.bind(affinity_key, replica)
+        return res
+
+    def _post_body(self, params):
+        # large parameter sets are sent as a JSON body, instead of a long query string
+        threshold = exposer.get_instrument_option(self.instrument_name, 'post_params_threshold')
+        if threshold is None or not params:
+            return None
+        if sum(len(str(k)) + len(str(v)) for k, v in params.items()) <= threshold:
+            return None
+        return json.dumps({k: compact_json_value(v) for k, v in params.items()}, separators=(',', ':'), default=str)
+
+    def _backend_fetch(self, url, params=None, endpoint='get', product=None):
+        headers = {'Accept-Encoding': ACCEPT_ENCODING if self.compress_transfer else 'identity'}
+        body = self._post_body(params) if endpoint == 'get' else None
+        with metrics.timer('backend_request', instrument=self.instrument_name, product=product, endpoint=endpoint):
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+                res = requests.post(url, data=body, headers=headers, stream=True)
+            else:
+                res = requests.get(url, params=params, headers=headers, stream=True)
+            # reading the body here decodes it chunk by chunk, 
+            # while the raw stream keeps track of the bytes actually received
+            decoded_size = len(res.content)
+        metrics.inc('backend_requests', instrument=self.instrument_name, endpoint=endpoint, status=res.status_code)
+        raw_size = res.raw.tell() if res.raw is not None else decoded_size
+        # bytes received from the backend: raw as transferred (possibly compressed), decoded after content decoding
+        metrics.inc('backend_transfer_bytes', raw_size, instrument=self.instrument_name, kind='raw')
+        metrics.inc('backend_transfer_bytes', decoded_size, instrument=self.instrument_name, kind='decoded')
+        logger.debug('received %s bytes (%s decoded, content-encoding: %s) from %s',
+                     raw_size, decoded_size, res.headers.get('content-encoding', 'identity'), url)
+        return res
         
     @property
-    def backend_options(self, max_trial=5, sleep_seconds=5):
+    def backend_options(self):
         try:
             options_dict = self._backend_options
         except AttributeError:
-            url = self.data_server_url.strip('/') + '/api/v1.0/options'
-            for i in range(max_trial):
-                try:
-                    res = requests.get("%s" % (url), params=None)
-
-                    if res.status_code == 200:
-                        options_dict = res.json()
-                        backend_available = True
-                        break
-                    else:
-                        raise RuntimeError("Backend options request failed. " 
-                                           f"Exit code: {res.status_code}. "
-                                           f"Response: {res.text}")
-                except Exception as e:
-                    backend_available = False
-                    logger.error(f"Exception while getting backend options {repr(e)}")
-                    time.sleep(sleep_seconds)
-            if not backend_available:
+            # with the shared store, one worker fetches the options and the others reuse them
+            options_dict = shared_store.get_or_refresh(f'backend_options:{self.instrument_name}:{self.replicas.urls}',
+                                                       self._fetch_backend_options)
+            if options_dict is None:
+                # not cached, the options will be requested again with the next query
                 return {}
 
             self._backend_options = options_dict
         return options_dict
+
+    def _fetch_backend_options(self, max_trial=5, sleep_seconds=5):
+        options_key = (self.instrument_name, tuple(self.replicas.urls))
+        for i in range(max_trial):
+            try:
+                # without the options the instrument has no product queries, so they may use
+                # the admission slot reserved for them when the product requests take all the others
+                res = self._backend_get('api/v1.0/options', endpoint='options', reserved=True)
+
+                if res.status_code == 200:
+                    options_dict = response_json(res)
+                    with _last_backend_options_lock:
+                        _last_backend_options[options_key] = options_dict
+                    return options_dict
+                else:
+                    raise RuntimeError("Backend options request failed. " 
+                                       f"Exit code: {res.status_code}. "
+                                       f"Response: {res.text}")
+            except BackendBusy as e:
+                with _last_backend_options_lock:
+                    last_options = _last_backend_options.get(options_key)
+                if last_options is not None:
+                    logger.warning(f"Backend options not requested, using the last ones: {e}")
+                    return last_options
+                # the reserved slot was not free within queue_timeout either
+                logger.error(f"Backend options not requested: {e}")
+                return None
+            except Exception as e:
+                logger.error(f"Exception while getting backend options {repr(e)}")
+                time.sleep(sleep_seconds)
+        return None
         
     def get_backend_comment(self, product):
         comment_uri = 'http://odahub.io/ontology#WorkflowResultComment'
@@ -127,44 +259,81 @@ class NB2WDataDispatcher:
             param_dict['_async_request_callback'] = call_back_url
             param_dict['_async_request'] = "yes"
 
-        url = os.path.join(self.data_server_url, 'api/v1.0/get', task.strip('/'))
+        path = 'api/v1.0/get/' + task.strip('/')
         payload = {}
         for k, v in param_dict.items():
             if v is None and k != '_token':
                 payload[k] = '\x00'
             else:
                 payload[k] = v
-        res = requests.get(url, params=payload)
+        try:
+            res = self._backend_get(path, params=payload, product=task.strip('/'))
+        except BackendBusy as e:
+            self._handle_backend_busy(e, query_out, task, logger)
+            metrics.end_request(instrument=self.instrument_name, product=task.strip('/'))
+            return res_trace_dict, query_out
+
         if res.status_code in [200, 201]:
-            res_data = res.json()
+            with metrics.timer('backend_json_parse', instrument=self.instrument_name, product=task.strip('/')):
+                res_data = response_json(res)
             workflow_status = res_data['workflow_status'] if run_asynch else 'done'
             if workflow_status == 'started' or workflow_status == 'done':
                 resroot = res_data['data'] if run_asynch and workflow_status == 'done' else res_data
                 jobdir = resroot.get('jobdir', None)
                 if jobdir is not None:
                     jobdir = jobdir.split('/')[-1]
-                    trace_url = os.path.join(self.data_server_url, 'trace', jobdir, task.strip('/'))
+                    # the trace is only available from the replica running the job
+                    self.replicas.alias(('jobdir', jobdir), request_key(self.instrument_name, path, payload))
+                    if run_asynch:
+                        result_spool.remember(request_key(self.instrument_name, path, payload), jobdir)
+                    trace_path = '/'.join(['trace', jobdir, task.strip('/')])
                     query_string = {'include_glued_output': False} if not self.include_glued_output else {}
-                    res_trace = requests.get(trace_url, params=query_string)
-                    if res_trace.status_code in [200, 201]:
-                        res_trace_dict = {
-                            'res': res_trace,
-                            'progress_product': True
-                        }
-                        workflow_status = 'progress' if workflow_status == 'started' else workflow_status
-                        query_out.set_status(0, job_status=workflow_status)
+                    try:
+                        res_trace = self._backend_get(trace_path, 
+                                                      params=query_string, 
+                                                      endpoint='trace', 
+                                                      product=task.strip('/'), 
+                                                      affinity_key=('jobdir', jobdir))
+                    except BackendBusy as e:
+                        self._handle_backend_busy(e, query_out, task, logger)
                     else:
-                        self._handle_backend_error(res_trace, query_out, task, logger, subtask="requesting trace")
+                        if res_trace.status_code in [200, 201]:
+                            res_trace_dict = {
+                                'res': res_trace,
+                                'progress_product': True,
+                                'jobdir': jobdir
+                            }
+                            # only the outputs which the backend reports as complete
+                            partial_output = resroot.get('partial_output')
+                            if workflow_status == 'started' and partial_output:
+                                # outputs already complete, delivered with the progress
+                                res_trace_dict['partial_output'] = partial_output
+                            workflow_status = 'progress' if workflow_status == 'started' else workflow_status
+                            query_out.set_status(0, job_status=workflow_status)
+                        else:
+                            self._handle_backend_error(res_trace, query_out, task, logger, subtask="requesting trace")
                 else:
                     self._handle_backend_error(res, query_out, task, logger, subtask="extracting the jobdir from the option response")
         else:
             self._handle_backend_error(res, query_out, task, logger, subtask="calling the option endpoint")
 
+        if res_trace_dict is None:
+            # no products will be built in this request
+            metrics.end_request(instrument=self.instrument_name, product=task.strip('/'))
+
         return res_trace_dict, query_out
 
+    def _handle_backend_busy(self, excep, query_out, task, logger):
+        query_out.set_failed('Backend busy', 
+                             message=f'The backend of task {task.strip("/")} is busy, please retry later',
+                             e_message=str(excep),
+                             job_status='failed')
+        if logger:
+            logger.warning(f'Request of task {task.strip("/")} not sent: {excep}')
+
     def _handle_backend_error(self, res, query_out, task, logger, subtask=None):
         if 'application/json' in res.headers.get('content-type', ''):
-            e_message = res.json().get('exceptions', [res.text])[0]
+            e_message = response_json(res).get('exceptions', [res.text])[0]
         else:
             e_message = res.text
         message = f'Error in the backend, task {task.strip("/")}'
@@ -204,39 +373,54 @@ class NB2WDataDispatcher:
             param_dict['_async_request_callback'] = call_back_url
             param_dict['_async_request'] = "yes"
 
-        url = '/'.join([self.data_server_url.strip('/'), 'api/v1.0/get', task.strip('/')])
+        path = 'api/v1.0/get/' + task.strip('/')
         
         for k,v in param_dict.items():
             if v is None and k != '_token':
                 param_dict[k] = '\x00'
 
-        res = requests.get(url, params = param_dict)
+        key = request_key(self.instrument_name, path, param_dict)
+        if run_asynch:
+            # once the job is complete, its result may be read from the spool shared with the backend
+            res = result_spool.read(exposer.get_instrument_option(self.instrument_name, 'result_spool'),
+                                    key,
+                                    instrument=self.instrument_name,
+                                    product=task.strip('/'))
+        try:
+            if res is None:
+                res = self._backend_get(path, params = param_dict, product=task.strip('/'))
+        except BackendBusy as e:
+            self._handle_backend_busy(e, query_out, task, logger)
+            metrics.end_request(instrument=self.instrument_name, product=task.strip('/'))
+            return res, query_out
+
         if res.status_code == 200:
-            resroot = res.json()['data'] if run_asynch else res.json()
+            with metrics.timer('backend_json_parse', instrument=self.instrument_name, product=task.strip('/')):
+                res_json = response_json(res)
+            resroot = res_json['data'] if run_asynch else res_json
             
             except_message = None
             if resroot['exceptions']: 
                 if isinstance(resroot['exceptions'][0], dict): # in async
-                    except_message = resroot['exceptions'][0]['ename']+': '+res.json()['data']['exceptions'][0]['evalue']
+                    except_message = resroot['exceptions'][0]['ename']+': '+resroot['exceptions'][0]['evalue']
                 else:
-                    except_message = res.json()['exceptions'][0]
+                    except_message = resroot['exceptions'][0]
                                                             
                 query_out.set_failed('Backend exception', 
                                     message='Backend failed. ' + except_message,
                                     job_status='failed')
+                metrics.end_request(instrument=self.instrument_name, product=task.strip('/'))
                 return res, query_out
 
             comment_name = self.get_backend_comment(task.strip('/'))
             comment_value = ''
             if comment_name:
-                if run_asynch: 
-                    comment_value = res.json()['data']['output'][comment_name]
-                else:
-                    comment_value = res.json()['output'][comment_name]
+                comment_value = resroot['output'][comment_name]
         
             query_out.set_done(message=message, debug_message=str(debug_message),job_status='done', comment=comment_value)
         elif res.status_code == 201:
-            if res.json()['workflow_status'] == 'submitted':
+            result_spool.remember(key, response_json(res).get('jobdir'))
+            if response_json(res)['workflow_status'] == 'submitted':
                 query_out.set_status(0, message=message, debug_message=str(debug_message),job_status='submitted')
             else:
                 query_out.set_status(0, message=message, debug_message=str(debug_message),job_status='progress')
@@ -245,10 +429,14 @@ class NB2WDataDispatcher:
             try:
                 query_out.set_failed('Error in the backend', 
                                  message='connection status code: ' + str(res.status_code), 
-                                 extra_message=res.json()['exceptions'][0])
+                                 extra_message=response_json(res)['exceptions'][0])
             except:
                 query_out.set_failed('Error in the backend', 
                                  message='connection status code: ' + str(res.status_code), 
                                  extra_message = res.text)
 
+        if query_out.get_job_status() != 'done':
+            # otherwise the request is completed by the product processing
+            metrics.end_request(instrument=self.instrument_name, product=task.strip('/'))
+
         return res, query_out
@@ -0,0 +1,89 @@
+import ast
+import binascii
+import gzip
+import io
+import json
+import logging
+import pickle
+import re
+
+logger = logging.getLogger(__name__)
+
+# base64 characters decoded at a time, a multiple of 4
+chunk_size = 1 << 22
+
+_whitespace = re.compile(r'\s')
+
+
+class _Base64Reader(io.RawIOBase):
+    """
+    Binary stream of the data encoded in a base64 string, decoded one chunk
+    at a time when it is read.
+    """
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.pos = 0
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._pending:
+            if self.pos >= len(self.encoded):
+                return 0
+            self._pending = memoryview(binascii.a2b_base64(self.encoded[self.pos:self.pos + chunk_size]))
+            self.pos += chunk_size
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def _open_binarys(encoded):
+    stream = io.BufferedReader(_Base64Reader(encoded), buffer_size=io.DEFAULT_BUFFER_SIZE)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    return stream
+
+
+def decode_numpy_data_unit(encoded_unit):
+    """
+    Same as NumpyDataUnit.decode, but the pickled array is read from the base64 text
+    as it is decoded (and decompressed, if gzipped): the unpickler reads the data directly
+    into the buffer of the array, without holding the whole decoded payload in between.
+    """
+    from oda_api.data_products import NumpyDataUnit
+
+    binarys = encoded_unit.get('binarys')
+    # the chunks are only aligned to the base64 quanta without whitespace
+    if not isinstance(binarys, str) or _whitespace.search(binarys):
+        return NumpyDataUnit.decode(encoded_unit, from_json=False)
+
+    with _open_binarys(binarys) as stream:
+        data = pickle.Unpickler(stream, encoding='bytes').load()
+
+    return NumpyDataUnit(data=data,
+                         data_header=encoded_unit['header'],
+                         meta_data=encoded_unit['meta_data'],
+                         name=encoded_unit['name'],
+                         hdu_type=encoded_unit['hdu_type'],
+                         units_dict=encoded_unit.get('units_dict'))
+
+
+def decode_numpy_data_product(encoded_obj):
+    from oda_api.data_products import NumpyDataProduct
+
+    if not isinstance(encoded_obj, dict):
+        return NumpyDataProduct.decode(encoded_obj)
+
+    meta_data = encoded_obj['meta_data']
+    if isinstance(meta_data, str):
+        try:
+            meta_data = json.loads(meta_data)
+        except ValueError:
+            meta_data = ast.literal_eval(meta_data)
+
+    return NumpyDataProduct(data_unit=[decode_numpy_data_unit(x) for x in encoded_obj['data_unit_list']],
+                            name=encoded_obj['name'],
+                            meta_data=meta_data)
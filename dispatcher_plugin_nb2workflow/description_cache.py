@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+from functools import wraps
+
+from .util import ontology_version, atomic_write
+from .shared_store import shared_store
+
+logger = logging.getLogger(__name__)
+
+
+def _distribution_version(name):
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError: # pragma: no cover
+        return 'unknown'
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return 'unknown'
+
+_code_version = None
+def code_version():
+    """
+    Version stamp of the code producing the cached descriptions: the plugin
+    (including the contents of its source files, as the package version is rarely bumped)
+    and the packages defining the parameter classes.
+    It does not depend on the file modification times, so it is the same in all the 
+    deployments of the same code.
+    """
+    global _code_version
+    if _code_version is None:
+        plugin_dir = os.path.dirname(__file__)
+        sources_hash = hashlib.sha256()
+        for fn in sorted(fn for fn in os.listdir(plugin_dir) if fn.endswith('.py')):
+            with open(os.path.join(plugin_dir, fn), 'rb') as fd:
+                sources_hash.update(f'{fn}\0'.encode())
+                sources_hash.update(hashlib.sha256(fd.read()).digest())
+        _code_version = json.dumps([_distribution_version('dispatcher-plugin-nb2workflow'),
+                                    _distribution_version('cdci_data_analysis'),
+                                    _distribution_version('oda_api'),
+                                    sources_hash.hexdigest()])
+    return _code_version
+
+
+class DescriptionCache:
+    """
+    Parsed backend descriptions stored in a local directory, shared by the workers
+    and kept across restarts. Entries are keyed by a hash of the description,
+    the ontology source and version and the code version.
+    Files are written to a temporary name and renamed, so readers never see partial entries.
+    Without a directory, the entries are kept in the shared store, if it is configured.
+    """
+    def __init__(self):
+        self.directory = None
+
+    def configure(self, directory):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.directory is not None or shared_store.enabled
+
+    def _path(self, kind, descr, ontology_path):
+        key = json.dumps([kind, descr, ontology_path, ontology_version(ontology_path), code_version()],
+                         sort_keys=True, default=str)
+        name = f'{kind}-{hashlib.sha256(key.encode()).hexdigest()}'
+        if self.directory is None:
+            return f'description:{name}'
+        return os.path.join(self.directory, f'{name}.pkl')
+
+    def get(self, path, kind):
+        if self.directory is None:
+            return shared_store.get(path)
+        try:
+            with open(path, 'rb') as fd:
+                return pickle.load(fd)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('Unable to read the cached %s description: %s', kind, e)
+            return None
+
+    def put(self, path, kind, value):
+        if self.directory is None:
+            shared_store.put(path, value)
+            return
+        try:
+            with atomic_write(path) as fd:
+                pickle.dump(value, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning('Unable to cache the %s description: %s', kind, e)
+
+    def cached(self, kind, dump=None, load=None):
+        """
+        Decorator of the description parsing functions, called with the
+        bk_descript_dict and ontology_path keyword arguments.
+        dump and load convert the result to and from its picklable form.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, bk_descript_dict = {}, ontology_path = None):
+                if not self.enabled:
+                    return func(*args, bk_descript_dict=bk_descript_dict, ontology_path=ontology_path)
+
+                path = self._path(kind, bk_descript_dict, ontology_path)
+                stored = self.get(path, kind)
+                if stored is not None:
+                    try:
+                        return load(stored) if load is not None else stored
+                    except Exception as e:
+                        logger.warning('Unable to restore the cached %s description: %s', kind, e)
+
+                result = func(*args, bk_descript_dict=bk_descript_dict, ontology_path=ontology_path)
+                self.put(path, kind, dump(result) if dump is not None else result)
+                return result
+            return wrapper
+        return decorator
+
+
+description_cache = DescriptionCache()
@@ -1,12 +1,19 @@
 from cdci_data_analysis.analysis.instrument import Instrument
 from cdci_data_analysis.analysis.queries import SourceQuery, InstrumentQuery
-from .queries import NB2WProductQuery, NB2WInstrumentQuery, NB2WSourceQuery
-from .dataserver_dispatcher import NB2WDataDispatcher
+from .dataserver_dispatcher import NB2WDataDispatcher, allowed_instrument_conf_keys
 from . import conf_file
+from .metrics import registry as metrics
+from .singleflight import group as singleflight_group
+from .description_cache import description_cache
+from .shared_store import shared_store
+from .product_store import product_store
+from .util import atomic_write
+import hashlib
 import json
+import pickle
+import threading
 import yaml
 import requests
-import rdflib as rdf
 import os
 from copy import copy
 
@@ -14,45 +21,156 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def kg_select(t, kg_conf_dict):
+def _kg_work_status_filter(work_statuses, variable='work_status'):
+    # "undefined" selects the services without creativeWorkStatus
+    if not work_statuses:
+        return ''
+    conditions = []
+    statuses = [x for x in work_statuses if x != 'undefined']
+    if statuses:
+        conditions.append(f'?{variable} IN ({", ".join(json.dumps(x) for x in statuses)})')
+    if 'undefined' in work_statuses:
+        conditions.append(f'!BOUND(?{variable})')
+    return f'FILTER ({" || ".join(conditions)})'
+
+# parsed file KGs, by path: ((mtime, size), graph)
+_kg_graphs = {}
+_kg_graphs_lock = threading.Lock()
+
+def _load_kg_graph(path, cache_path=None):
+    """
+    Returns the graph of the KG file, parsed once per version of the file.
+    If cache_path is set, the parsed graph is also pickled there, with the hash
+    of the file it was parsed from, so the other workers and the restarted ones
+    do not parse the text again.
+    """
+    import rdflib as rdf
+
+    if not os.path.isfile(path):
+        logger.warning("Knowledge graph file %s doesn't exist yet. " 
+                       "No instruments information will be loaded.", 
+                       path)
+        return rdf.Graph()
+
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _kg_graphs_lock:
+        known = _kg_graphs.get(path)
+    if known is not None and known[0] == stamp:
+        return known[1]
+
+    with open(path, 'rb') as fd:
+        digest = hashlib.sha256(fd.read()).hexdigest()
+
+    graph = None
+    if cache_path is not None:
+        try:
+            with open(cache_path, 'rb') as fd:
+                cached_digest, cached_graph = pickle.load(fd)
+            if cached_digest == digest:
+                graph = cached_graph
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning('Unable to read the cached KG %s: %s', cache_path, e)
+
+    if graph is None:
+        with metrics.timer('kg_parse'):
+            graph = rdf.Graph()
+            graph.parse(path)
+        if cache_path is not None:
+            _store_kg_graph(cache_path, digest, graph)
+
+    with _kg_graphs_lock:
+        _kg_graphs[path] = (stamp, graph)
+    return graph
+
+def _store_kg_graph(cache_path, digest, graph):
+    try:
+        with atomic_write(cache_path) as fd:
+            pickle.dump((digest, graph), fd, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        logger.warning('Unable to cache the parsed KG to %s: %s', cache_path, e)
+
+def _kg_binding(row, variables):
+    # same form as the bindings of the SPARQL JSON results, unbound variables are left out
+    from rdflib import Literal, BNode
+
+    binding = {}
+    for var in variables:
+        term = row[var]
+        if term is None:
+            continue
+        if isinstance(term, Literal):
+            binding[str(var)] = {'type': 'literal', 'value': str(term)}
+            if term.datatype is not None:
+                binding[str(var)]['datatype'] = str(term.datatype)
+            elif term.language is not None:
+                binding[str(var)]['xml:lang'] = term.language
+        elif isinstance(term, BNode):
+            binding[str(var)] = {'type': 'bnode', 'value': str(term)}
+        else:
+            binding[str(var)] = {'type': 'uri', 'value': str(term)}
+    return binding
+
+def kg_select(t, kg_conf_dict, variables=None, filters=''):
+    """
+    Yields the bindings of the graph pattern t, retrieved in pages of kg_conf_dict['page_size'] rows.
+    Only the listed variables are projected (all if None), the pages are ordered by them.
+    """
     if kg_conf_dict is None or kg_conf_dict == {}:
         logger.info('Not using KG to get instruments')
-        qres_js = []
-    elif kg_conf_dict.get('type') == 'query-service':
-        r = requests.get(kg_conf_dict['path'],
-                    params={"query": f"""
-                        SELECT * WHERE {{
-                            {t}
-                        }} LIMIT 100
-                    """})
-                    
-        if r.status_code != 200:
-            raise RuntimeError(f'{r}: {r.text}')
-        
-        qres_js = r.json()['results']['bindings']
+        return
+
+    page_size = kg_conf_dict.get('page_size', 100)
+    projection = ' '.join(f'?{x}' for x in variables) if variables else '*'
+    order = f'ORDER BY {projection}' if variables else ''
+
+    if kg_conf_dict.get('type') == 'query-service':
+        def run_query(query):
+            r = requests.get(kg_conf_dict['path'], params={"query": query})
+            if r.status_code != 200:
+                raise RuntimeError(f'{r}: {r.text}')
+            return r.json()['results']['bindings']
 
     elif kg_conf_dict.get('type') == 'file':
-        graph = rdf.Graph()
-        if os.path.isfile(kg_conf_dict['path']):
-            graph.parse(kg_conf_dict['path'])
-        else:
-            logger.warning("Knowledge graph file %s doesn't exist yet. " 
-                           "No instruments information will be loaded.", 
-                           kg_conf_dict['path'])
-        qres = graph.query(f"""
-                        SELECT * WHERE {{
-                            {t}
-                        }} LIMIT 100
-                    """)
-        qres_js = json.loads(qres.serialize(format='json'))['results']['bindings']
+        cache_path = kg_conf_dict.get('cache_path')
+        if cache_path is None and description_cache.directory is not None:
+            cache_path = os.path.join(description_cache.directory,
+                                      f"kg-{hashlib.sha256(os.path.abspath(kg_conf_dict['path']).encode()).hexdigest()}.pickle")
+        graph = _load_kg_graph(kg_conf_dict['path'], cache_path)
+        def run_query(query):
+            qres = graph.query(query)
+            return [_kg_binding(row, qres.vars) for row in qres]
     
     else:
         logger.warning('Unknown KG type')
-        qres_js = []
-            
-    logger.warning(json.dumps(qres_js, indent=4))
-    
-    return qres_js
+        return
+
+    n_rows = 0
+    offset = 0
+    while True:
+        with metrics.timer('kg_query'):
+            page = run_query(f"""
+                        SELECT {projection} WHERE {{
+                            {t}
+                            {filters}
+                        }} {order} LIMIT {page_size} OFFSET {offset}
+                    """)
+        logger.debug('KG page at offset %s: %s', offset, json.dumps(page))
+        n_rows += len(page)
+        yield from page
+        if len(page) < page_size:
+            break
+        offset += page_size
+
+    logger.info('KG query returned %s rows in %s pages', n_rows, offset // page_size + 1)
+
+# keys copied as they are from the plugin config file: the plugin-wide settings, 
+# and the plugin-wide defaults of the per-instrument options
+static_conf_keys = (['ontology_path', 'kg', 'include_glued_output', 'compress_transfer', 'metrics', 'profiling',
+                     'single_flight', 'shared_store', 'description_cache_dir', 'product_store'] +
+                    [key for key in allowed_instrument_conf_keys if key not in ['restricted_access', 'creativeWorkStatus']])
 
 def get_static_instr_conf(conf_file):
     masked_conf_file = conf_file
@@ -60,7 +178,7 @@ def get_static_instr_conf(conf_file):
     # kg_conf_dict = {'type': 'query-service',  
     #                 'path': "https://www.astro.unige.ch/mmoda/dispatch-data/gw/odakb/query"}
     
-    cfg_dict = {'instruments': {}, 'kg': {}, 'include_glued_output': True}
+    cfg_dict = {'instruments': {}, 'kg': {}, 'include_glued_output': True, 'compress_transfer': True}
     
     if conf_file is not None:
         with open(conf_file, 'r') as ymlfile:
@@ -71,17 +189,22 @@ def get_static_instr_conf(conf_file):
                 else:
                     masked_conf_file = None 
                     # need to set to None as it's being read inside Instrument
-                if 'ontology_path' in f_cfg_dict.keys():
-                    cfg_dict['ontology_path'] = f_cfg_dict['ontology_path']
-                if 'kg' in f_cfg_dict.keys():
-                    cfg_dict['kg'] = f_cfg_dict['kg']
-                if 'include_glued_output' in f_cfg_dict.keys():
-                    cfg_dict['include_glued_output'] = f_cfg_dict['include_glued_output']
+                for key in static_conf_keys:
+                    if key in f_cfg_dict.keys():
+                        cfg_dict[key] = f_cfg_dict[key]
             else:
                 masked_conf_file = None
     return cfg_dict, masked_conf_file
 
 static_config_dict, masked_conf_file = get_static_instr_conf(conf_file)
+metrics.configure(static_config_dict.get('metrics'))
+singleflight_group.configure(static_config_dict.get('single_flight'))
+shared_store.configure(static_config_dict.get('shared_store'))
+description_cache.configure(static_config_dict.get('description_cache_dir'))
+product_store.configure(static_config_dict.get('product_store'))
+
+# imported once the metrics are configured, as the stage timers of the queries are set up when they are defined
+from .queries import NB2WProductQuery, NB2WInstrumentQuery, NB2WSourceQuery
 
 if 'ODA_ONTOLOGY_PATH' in os.environ:
     ontology_path = os.environ.get('ODA_ONTOLOGY_PATH')
@@ -100,11 +223,25 @@ def get_config_dict_from_kg(kg_conf_dict=static_config_dict['kg']):
                 OPTIONAL {
                     ?w <https://schema.org/creativeWorkStatus> ?work_status .
                 }
-            ''', kg_conf_dict):
+            ''', 
+            kg_conf_dict, 
+            variables=['w', 'deployment_name', 'service_name', 'work_status'],
+            filters=_kg_work_status_filter(kg_conf_dict.get('creativeWorkStatus') if kg_conf_dict else None)):
 
-        logger.info('found instrument service record %s', r)
+        logger.debug('found instrument service record %s', r)
+        data_server_url = f"http://{r['deployment_name']['value']}:8000"
+        known_instr = cfg_dict['instruments'].get(r['service_name']['value'])
+        if known_instr is not None:
+            # several deployments of the same service are replicas of its backend
+            replica_urls = known_instr['data_server_url']
+            if isinstance(replica_urls, str):
+                replica_urls = [replica_urls]
+            if data_server_url not in replica_urls:
+                data_server_url = replica_urls + [data_server_url]
+            else:
+                data_server_url = known_instr['data_server_url']
         cfg_dict['instruments'][r['service_name']['value']] = {
-            "data_server_url": f"http://{r['deployment_name']['value']}:8000",
+            "data_server_url": data_server_url,
             "dummy_cache": "",
             "creativeWorkStatus": r.get('work_status', {'value': 'undefined'})['value'], 
                 # creativeWorkStatus isn't currently used further in plugin but may be used in the future. Useful in test, though.
@@ -113,30 +250,48 @@ def get_config_dict_from_kg(kg_conf_dict=static_config_dict['kg']):
     
     return cfg_dict
 
+# built on first use, not to query the KG while the plugin is being imported
 combined_instrument_dict = {}
+combined_instrument_dict_built = False
 def build_combined_instrument_dict():
-    global combined_instrument_dict
+    global combined_instrument_dict, combined_instrument_dict_built
     combined_instrument_dict = copy(static_config_dict.get('instruments', {}))
-    combined_instrument_dict.update(get_config_dict_from_kg()['instruments'])
+    # with the shared store, one worker queries the KG and the others use its snapshot
+    kg_instruments = shared_store.get_or_refresh('kg_snapshot:' + json.dumps(static_config_dict['kg'], sort_keys=True),
+                                                 lambda: get_config_dict_from_kg()['instruments'],
+                                                 ttl=static_config_dict.get('shared_store', {}).get('kg_ttl', 60))
+    combined_instrument_dict.update(kg_instruments)
+    combined_instrument_dict_built = True
+
+def get_combined_instrument_dict():
+    if not combined_instrument_dict_built:
+        build_combined_instrument_dict()
+    return combined_instrument_dict
 
-build_combined_instrument_dict()
+def get_instrument_option(instr_name, key, default=None):
+    # instrument-level setting, falling back to the plugin-wide one
+    instr_conf = get_combined_instrument_dict().get(instr_name, {})
+    if key in instr_conf:
+        return instr_conf[key]
+    return static_config_dict.get(key, default)
 
 def factory_factory(instr_name, restricted_access):
     instrument_query = NB2WInstrumentQuery('instr_query', restricted_access)
     def instr_factory():
         backend_options = NB2WDataDispatcher(instrument=instr_name).backend_options
-        query_list, query_dict = NB2WProductQuery.query_list_and_dict_factory(backend_options, 
-                                                                              ontology_path)
-        return Instrument(instr_name,
-                        src_query = NB2WSourceQuery.from_backend_options(backend_options, 
-                                                                         ontology_path),
-                        instrumet_query = instrument_query,
-                        data_serve_conf_file=masked_conf_file,
-                        product_queries_list=query_list,
-                        query_dictionary=query_dict,
-                        asynch=True, 
-                        data_server_query_class=NB2WDataDispatcher,
-                        )
+        with metrics.timer('instrument_build', instrument=instr_name):
+            query_list, query_dict = NB2WProductQuery.query_list_and_dict_factory(backend_options, 
+                                                                                  ontology_path)
+            return Instrument(instr_name,
+                            src_query = NB2WSourceQuery.from_backend_options(backend_options, 
+                                                                             ontology_path),
+                            instrumet_query = instrument_query,
+                            data_serve_conf_file=masked_conf_file,
+                            product_queries_list=query_list,
+                            query_dictionary=query_dict,
+                            asynch=True, 
+                            data_server_query_class=NB2WDataDispatcher,
+                            )
     instr_factory.instr_name = instr_name
     instr_factory.instrument_query = instrument_query
     return instr_factory
@@ -160,7 +315,8 @@ class NB2WInstrumentFactoryIter:
                 self.lst.pop(idx)
         
         if new_instrs:
-            for instr in new_instrs:
+            # keep the order of the config
+            for instr in [x for x in available_instrs if x in new_instrs]:
                 self.lst.append(factory_factory(instr, combined_instrument_dict[instr].get('restricted_access', False)))
         
         # check if some instruments changed status
@@ -177,7 +333,7 @@ class NB2WInstrumentFactoryIter:
         self._update_instruments_list()
         return self.lst.__iter__()    
                     
-instr_factory_list = [ factory_factory(instr_name, instr_conf.get('restricted_access', False)) 
-                       for instr_name, instr_conf in combined_instrument_dict.items()]
-
-instr_factory_list = NB2WInstrumentFactoryIter(instr_factory_list)
+# the factories are added on the first iteration. The dispatcher's plugin importer iterates
+# the list (extending its own list with it) when it imports the plugin, so the KG is still
+# queried once at the dispatcher start, in every worker unless the shared store is configured
+instr_factory_list = NB2WInstrumentFactoryIter([])
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _StageTimer:
+    __slots__ = ('registry', 'stage', 'labels', 't0')
+
+    def __init__(self, registry, stage, labels):
+        self.registry = registry
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.stage, time.perf_counter() - self.t0, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    """
+    Low-overhead timers and counters of the plugin stages, labelled by instrument and product.
+
+    Disabled by default, in which case timer() returns a shared no-op context manager
+    and nothing is recorded. Collected values can be rendered in Prometheus text format
+    (optionally written to a textfile for the node exporter) or logged as one structured
+    line per request.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.log_requests = False
+        self.prometheus_textfile = None
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._counters = {}
+        self._gauges = {}
+        self._request = threading.local()
+
+    def configure(self, metrics_conf):
+        metrics_conf = metrics_conf or {}
+        self.enabled = bool(metrics_conf.get('enabled', False))
+        self.log_requests = bool(metrics_conf.get('log_requests', False))
+        self.prometheus_textfile = metrics_conf.get('prometheus_textfile')
+
+    def reset(self):
+        with self._lock:
+            self._durations = {}
+            self._counters = {}
+            self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def timer(self, stage, **labels):
+        if not self.enabled:
+            return _null_timer
+        return _StageTimer(self, stage, labels)
+
+    def timed(self, stage):
+        """
+        Decorator timing the calls of a function. It is decided when the function is decorated:
+        if the metrics are disabled then, the function is returned unchanged.
+        """
+        def decorator(func):
+            if not self.enabled:
+                return func
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with _StageTimer(self, stage, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, stage, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(stage, labels)
+        with self._lock:
+            count, total, maximum = self._durations.get(key, (0, 0., 0.))
+            self._durations[key] = (count + 1, total + seconds, max(maximum, seconds))
+        if self.log_requests:
+            stages = getattr(self._request, 'stages', None)
+            if stages is None:
+                stages = self._request.stages = {}
+            stages[stage] = stages.get(stage, 0.) + seconds
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def end_request(self, **labels):
+        """
+        Called at the end of the plugin part of a dispatcher request.
+        Logs the collected stage durations and updates the Prometheus textfile.
+        """
+        if not self.enabled:
+            return
+        if self.log_requests:
+            stages = getattr(self._request, 'stages', None) or {}
+            self._request.stages = {}
+            logger.info('nb2w request metrics: %s',
+                        json.dumps({**{k: v for k, v in labels.items() if v is not None},
+                                    'stages': {k: round(v, 6) for k, v in stages.items()}}))
+        if self.prometheus_textfile:
+            self.write_textfile(self.prometheus_textfile.format(pid=os.getpid()))
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    def render_prometheus(self):
+        with self._lock:
+            durations = dict(self._durations)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+
+        lines = []
+        if durations:
+            lines.append('# HELP nb2w_stage_duration_seconds Time spent in the plugin stages')
+            lines.append('# TYPE nb2w_stage_duration_seconds summary')
+            for (stage, labels), (count, total, _) in sorted(durations.items()):
+                lab = self._format_labels((('stage', stage),) + labels)
+                lines.append(f'nb2w_stage_duration_seconds_count{lab} {count}')
+                lines.append(f'nb2w_stage_duration_seconds_sum{lab} {total:.6f}')
+            lines.append('# HELP nb2w_stage_duration_seconds_max Longest observed duration of the plugin stages')
+            lines.append('# TYPE nb2w_stage_duration_seconds_max gauge')
+            for (stage, labels), (_, _, maximum) in sorted(durations.items()):
+                lab = self._format_labels((('stage', stage),) + labels)
+                lines.append(f'nb2w_stage_duration_seconds_max{lab} {maximum:.6f}')
+
+        for name in sorted(set(k[0] for k in counters)):
+            lines.append(f'# TYPE nb2w_{name}_total counter')
+            for (cname, labels), value in sorted(counters.items()):
+                if cname == name:
+                    lines.append(f'nb2w_{name}_total{self._format_labels(labels)} {value}')
+
+        for name in sorted(set(k[0] for k in gauges)):
+            lines.append(f'# TYPE nb2w_{name} gauge')
+            for (gname, labels), value in sorted(gauges.items()):
+                if gname == name:
+                    lines.append(f'nb2w_{name}{self._format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        try:
+            with atomic_write(path, 'w') as fd:
+                fd.write(self.render_prometheus())
+        except OSError as e:
+            logger.warning('Unable to write metrics to %s: %s', path, e)
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+
+from .metrics import registry as metrics
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+# characters of the payload strings hashed at a time
+digest_chunk_size = 1 << 20
+
+
+def _update_digest(digest, value):
+    # the payload is hashed as it is walked, without serializing it:
+    # each value is tagged with its type and length, and long strings are encoded in chunks
+    if isinstance(value, str):
+        digest.update(b's%d:' % len(value))
+        for i in range(0, len(value), digest_chunk_size):
+            digest.update(value[i:i + digest_chunk_size].encode('utf-8', 'surrogatepass'))
+    elif isinstance(value, dict):
+        digest.update(b'd%d:' % len(value))
+        for key in sorted(value, key=str):
+            _update_digest(digest, str(key))
+            _update_digest(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'l%d:' % len(value))
+        for item in value:
+            _update_digest(digest, item)
+    elif isinstance(value, (bytes, bytearray)):
+        digest.update(b'b%d:' % len(value))
+        digest.update(value)
+    else:
+        digest.update(b'o' + json.dumps(value, default=str).encode())
+
+
+def payload_size(value):
+    # characters of the strings in the encoded payload, roughly the size of its decoded data
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(payload_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(item) for item in value)
+    return 8
+
+
+def payload_digest(encoded_data):
+    digest = hashlib.sha256()
+    _update_digest(digest, encoded_data)
+    return digest.hexdigest()
+
+
+def file_digest(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as fd:
+        while True:
+            block = fd.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ProductStore:
+    """
+    Content-addressed store of the product files, shared by the jobs.
+
+    The files are kept once in objects/<sha256 of the content>, and hardlinked
+    (read-only) into the job directories. The products are also indexed by the digest
+    of their encoded payload, name, type and writing options, so that a product
+    already written for an earlier job is linked without being written again.
+    The number of links of an object counts the jobs using it: objects
+    linked only from the store are removed by the periodic cleanup.
+    """
+    def __init__(self):
+        self.path = None
+        self.cleanup_interval = 3600
+        self._last_cleanup = 0.
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, store_conf):
+        store_conf = store_conf or {}
+        self.path = store_conf.get('path')
+        self.cleanup_interval = store_conf.get('cleanup_interval', 3600)
+        if self.path is not None:
+            os.makedirs(os.path.join(self.path, 'objects'), exist_ok=True)
+            os.makedirs(os.path.join(self.path, 'index'), exist_ok=True)
+
+    def _object_path(self, blob):
+        return os.path.join(self.path, 'objects', blob)
+
+    def _index_path(self, key):
+        return os.path.join(self.path, 'index', key)
+
+    @staticmethod
+    def _link(src, dst):
+        with atomic_write(dst, mode=None) as tmp_path:
+            os.link(src, tmp_path)
+
+    def _read_index(self, key):
+        try:
+            with open(self._index_path(key)) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def _write_index(self, key, entry):
+        with atomic_write(self._index_path(key), 'w') as fd:
+            json.dump(entry, fd)
+
+    def write(self, product, options=None):
+        """
+        Writes the product file, or links the stored copy of an identical one
+        """
+        digest = getattr(product, 'payload_digest', None)
+        if not self.enabled or digest is None:
+            product.write()
+            return
+
+        key = hashlib.sha256(json.dumps([getattr(product, 'type_key', None), product.name, options, digest],
+                                        sort_keys=True, default=str).encode()).hexdigest()
+        entry = self._read_index(key)
+        if entry is not None:
+            file_path = os.path.join(product.out_dir, entry['file_name'])
+            try:
+                self._link(self._object_path(entry['blob']), file_path)
+                product.file_path = file_path
+                metrics.inc('product_store_hit', product=product.name)
+                return
+            except OSError as e:
+                logger.debug('Stored product %s is not available: %s', entry['blob'], e)
+
+        product.write()
+        file_path = getattr(product, 'file_path', None)
+        if file_path is None:
+            return
+
+        try:
+            blob = file_digest(file_path)
+            object_path = self._object_path(blob)
+            try:
+                os.link(file_path, object_path)
+                os.chmod(object_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            except FileExistsError:
+                # same content written for another job, or with other options
+                self._link(object_path, file_path)
+                metrics.inc('product_store_dedup', product=product.name)
+            self._write_index(key, {'blob': blob, 'file_name': os.path.basename(file_path)})
+        except OSError as e:
+            # e.g. the store and the job directories on different filesystems
+            logger.warning('Unable to store the product file %s: %s', file_path, e)
+
+        self._maybe_cleanup()
+
+    def _maybe_cleanup(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < self.cleanup_interval:
+                return
+            self._last_cleanup = now
+        self.cleanup()
+
+    def cleanup(self):
+        removed = 0
+        objects_dir = os.path.join(self.path, 'objects')
+        with os.scandir(objects_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_nlink <= 1:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+        with os.scandir(os.path.join(self.path, 'index')) as entries:
+            for entry in entries:
+                if '.' in entry.name:
+                    # being written
+                    continue
+                index_entry = self._read_index(entry.name)
+                if index_entry is None or not os.path.exists(self._object_path(index_entry['blob'])):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+        if removed:
+            logger.info('Removed %s unused products from the store', removed)
+        return removed
+
+
+product_store = ProductStore()
@@ -3,18 +3,27 @@ from __future__ import annotations
 import logging
 import os
 import json
+import shutil
+import tempfile
 
 from cdci_data_analysis.analysis.products import LightCurveProduct, BaseQueryProduct, ImageProduct, SpectrumProduct
 from cdci_data_analysis.analysis.parameters import Parameter, subclasses_recursive
 from cdci_data_analysis.analysis.exceptions import ProductProcessingError
-from oda_api.data_products import NumpyDataProduct, ODAAstropyTable, BinaryProduct, PictureProduct
 
-from .util import AstropyTableViewParser, with_hashable_dict
-from oda_api.ontology_helper import Ontology
+from .util import AstropyTableViewParser, with_hashable_dict, ontology_version
+from .metrics import registry as metrics
+from .description_cache import description_cache
+from .decoding import decode_numpy_data_product
+from .product_store import product_store, payload_digest, payload_size
 from io import StringIO
 from functools import lru_cache  
+from threading import Lock
+from collections import OrderedDict
 from mimetypes import guess_extension
-from magic import from_buffer as mime_from_buffer
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from oda_api.ontology_helper import Ontology
 
 logger = logging.getLogger(__name__)
 
@@ -22,9 +31,19 @@ logger = logging.getLogger(__name__)
 
 # TODO: this should probably be defined in the main dispatcher code
 class TableProduct(BaseQueryProduct):
-    def __init__(self, name, table_data, file_dir = './', **kwargs):
+    # astropy format and file extension of the table_format values
+    formats = {'ecsv': ('ascii.ecsv', 'ecsv'),
+               'fits': ('fits', 'fits'),
+               'parquet': ('parquet', 'parquet')}
+
+    def __init__(self, name, table_data, file_dir = './', table_format = 'ecsv', **kwargs):
         self.table_data = table_data
-        fname = name if name.endswith('csv') else f"{name}.ecsv"
+        self.table_format = table_format
+        if table_format == 'ecsv':
+            fname = name if name.endswith('csv') else f"{name}.ecsv"
+        else:
+            extension = self.formats[table_format][1]
+            fname = name if name.endswith(f'.{extension}') else f"{name}.{extension}"
         super().__init__(name, file_name=fname, file_dir = file_dir, **kwargs)
 
     def encode(self):
@@ -36,11 +55,29 @@ class TableProduct(BaseQueryProduct):
         else:
             file_path = self.file_path.path
             
-        self.table_data.write(file_path, overwrite=overwrite, format='ascii.ecsv')
+        self.table_data.write(file_path, overwrite=overwrite, format=self.formats[self.table_format][0])
+
+
+def available_table_format(table_format):
+    """
+    The table_format if it can be written here, 'ecsv' otherwise
+    """
+    if table_format not in TableProduct.formats:
+        logger.warning('Unknown table format %s, writing ECSV', table_format)
+        return 'ecsv'
+    if table_format == 'parquet':
+        try:
+            import pyarrow # noqa: F401
+        except ImportError:
+            logger.warning('pyarrow is needed to write Parquet tables, writing ECSV')
+            return 'ecsv'
+    return table_format
 
 
 class NB2WProduct:
-    
+    # whether the output may be forwarded to the API clients as encoded by the backend
+    api_passthrough = False
+
     def __init__(self, *args, **kwargs):
         error_msg = "The output"
         name = kwargs.get('name', None)
@@ -61,25 +98,49 @@ class NB2WProduct:
     def _init_as_list(cls, encoded_data, *args, **kwargs):
         encoded_data = cls._dejsonify(encoded_data)
 
-        if isinstance(encoded_data, list):
-            return [cls(elem, *args, **kwargs) for elem in encoded_data]
+        if not isinstance(encoded_data, list):
+            encoded_data = [encoded_data]
 
-        return [cls(encoded_data, *args, **kwargs)]
+        prod_list = []
+        for elem in encoded_data:
+            product = cls(elem, *args, **kwargs)
+            if product_store.enabled:
+                product.payload_digest = payload_digest(elem)
+            prod_list.append(product)
+        return prod_list
+
+    @staticmethod
+    def _dump_prod_classes(prod_classes_dict):
+        # the parameter product classes are created at runtime, they are stored by their ontology term
+        return {key: (('parameter_product', prod_cls.type_key) 
+                      if issubclass(prod_cls, NB2WParameterProduct) and prod_cls is not NB2WParameterProduct
+                      else prod_cls, name, extra_kw)
+                for key, (prod_cls, name, extra_kw) in prod_classes_dict.items()}
+
+    @staticmethod
+    def _load_prod_classes(stored):
+        return {key: (parameter_products_registry.get_class(prod_cls[1]) 
+                      if isinstance(prod_cls, tuple) 
+                      else prod_cls, name, extra_kw)
+                for key, (prod_cls, name, extra_kw) in stored.items()}
 
     @classmethod
     @with_hashable_dict
     @lru_cache
+    @description_cache.cached('output', 
+                              dump=lambda res: NB2WProduct._dump_prod_classes(res), 
+                              load=lambda stored: NB2WProduct._load_prod_classes(stored))
+    @metrics.timed('output_description_analysis')
     def _prod_list_description_analyser(
         cls, 
         bk_descript_dict = {}, 
         ontology_path = None
         ) -> dict[str, tuple[type[NB2WProduct], str, dict]]:
 
+        onto = None
         if ontology_path is not None:
-            onto = Ontology(ontology_path)
-            par_prod_class_dict = {getattr(x, 'type_key'): x for x in parameter_products_factory(onto)}
+            par_prod_class_dict = {getattr(x, 'type_key'): x for x in parameter_products_factory(ontology_path)}
         else:
-            onto = None
             par_prod_class_dict = {}
 
         mapping = {getattr(x, 'type_key'): x for x in subclasses_recursive(cls) if hasattr(x, 'type_key')}
@@ -96,9 +157,13 @@ class NB2WProduct:
             if extra_ttl == '\n': extra_ttl = None
 
             if extra_ttl:
-                if onto is None:
+                if ontology_path is None:
                     logger.warning('Product description of %s contains extra_ttl, but no ontology is loaded. Ignoring extra_ttl.')
                 else:
+                    if onto is None:
+                        # only needed for the extra triples, its construction copies the whole ontology graph
+                        from oda_api.ontology_helper import Ontology
+                        onto = Ontology(ontology_path)
                     onto.parse_extra_triples(extra_ttl)
 
                     if owl_type not in mapping.keys():
@@ -126,20 +191,51 @@ class NB2WProduct:
 
 
     @classmethod
-    def prod_list_factory(cls, output_description_dict, output, out_dir = './', ontology_path = None):
-        
+    def prod_list_factory(cls, output_description_dict, output, out_dir = './', ontology_path = None, passthrough = False,
+                          partial = False, cache_scope = None):
+        """
+        With partial, the outputs which are not (yet) available are skipped.
+        With a cache_scope (identifying the job), the products decoded from the partial outputs
+        are kept, and reused while the same outputs are received for the same job.
+        The kept products of the job are released once its final result is built.
+        """
         prod_list = []
 
-        for key, val in cls._prod_list_description_analyser(bk_descript_dict=output_description_dict, 
-                                                            ontology_path=ontology_path).items():
-            try:
-                prod_list.extend(val[0]._init_as_list(output[key],
-                                                      out_dir=out_dir, 
-                                                      name=val[1],
-                                                      **val[2]))
-            except Exception as e:
-                logger.error('unable to construct %s product: %s from %s', key, e, val[0])
-                raise
+        try:
+            for key, val in cls._prod_list_description_analyser(bk_descript_dict=output_description_dict, 
+                                                                ontology_path=ontology_path).items():
+                if partial and key not in output:
+                    continue
+                digest = None
+                if cache_scope is not None and not (passthrough and val[0].api_passthrough):
+                    digest = payload_digest(output[key])
+                    cached = decoded_products.get((cache_scope, key), digest)
+                    if cached is not None:
+                        metrics.inc('product_cache_hit', product=key)
+                        prod_list.extend(cached)
+                        continue
+                try:
+                    with metrics.timer('product_decode', product=key):
+                        if passthrough and val[0].api_passthrough:
+                            products = NB2WEncodedProduct._init_as_list(output[key],
+                                                                        product_class=val[0],
+                                                                        out_dir=out_dir,
+                                                                        name=val[1],
+                                                                        extra_metadata=val[2].get('extra_metadata', {}))
+                        else:
+                            products = val[0]._init_as_list(output[key],
+                                                            out_dir=out_dir, 
+                                                            name=val[1],
+                                                            **val[2])
+                except Exception as e:
+                    logger.error('unable to construct %s product: %s from %s', key, e, val[0])
+                    raise
+                if digest is not None and partial:
+                    decoded_products.put((cache_scope, key), digest, products, payload_size(output[key]))
+                prod_list.extend(products)
+        finally:
+            if cache_scope is not None and not partial:
+                decoded_products.drop_scope(cache_scope)
 
         return prod_list
 
@@ -153,6 +249,93 @@ class NB2WProduct:
         return encoded_data
 
 
+class DecodedProductCache:
+    """
+    Products decoded from the partial outputs of a running job (identified by its scope),
+    reused by the following progress polls and the final result instead of being decoded again.
+    An entry is used only for the same encoded output, compared by its digest.
+    The entries are bounded by the total size of their encoded outputs (max_bytes),
+    the least recently used being dropped first.
+    A scope includes the output directory of the request, so releasing it once its final result
+    is built does not affect the other requests following the same backend job. Partial outputs of
+    a released scope, decoded by a poll still running at that time, are not kept.
+    """
+    def __init__(self, max_bytes=256 << 20, max_released_scopes=4096):
+        self.max_bytes = max_bytes
+        self.max_released_scopes = max_released_scopes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._released_scopes = OrderedDict()
+        self._lock = Lock()
+
+    def has_scope(self, scope):
+        with self._lock:
+            return scope in self._scopes
+
+    def get(self, key, digest):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != digest:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+        scope = key[0]
+        self._scopes[scope] -= 1
+        if self._scopes[scope] == 0:
+            del self._scopes[scope]
+
+    def put(self, key, digest, products, size):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes or key[0] in self._released_scopes:
+                return
+            self._entries[key] = (digest, products, size)
+            self._scopes[key[0]] = self._scopes.get(key[0], 0) + 1
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def drop_scope(self, scope):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == scope]:
+                self._remove(key)
+            self._released_scopes[scope] = True
+            self._released_scopes.move_to_end(scope)
+            while len(self._released_scopes) > self.max_released_scopes:
+                self._released_scopes.popitem(last=False)
+
+decoded_products = DecodedProductCache()
+
+
+class NB2WEncodedProduct(NB2WProduct):
+    """
+    The output as encoded by the backend, forwarded to the API clients without decoding
+    """
+    def __init__(self,
+                 encoded_data,
+                 product_class,
+                 out_dir=None,
+                 name='encoded',
+                 extra_metadata={}):
+        self.name = name
+        self.extra_metadata = extra_metadata
+        self.out_dir = out_dir
+        self.product_class = product_class
+        self.type_key = product_class.type_key
+        if isinstance(encoded_data, dict) and not encoded_data.get('name'):
+            encoded_data = {**encoded_data, 'name': name}
+        self.encoded_data = encoded_data
+
+    def write(self):
+        raise RuntimeError('Backend-encoded products are only passed to the API clients')
+
+
 class _CommentProduct(NB2WProduct):
     type_key = 'http://odahub.io/ontology#WorkflowResultComment'
 
@@ -164,6 +347,7 @@ class _CommentProduct(NB2WProduct):
 
 class NB2WNumpyDataProduct(NB2WProduct):
     type_key = 'http://odahub.io/ontology#NumpyDataProduct'
+    api_passthrough = True
 
     def __init__(self,
                  encoded_data,
@@ -176,7 +360,7 @@ class NB2WNumpyDataProduct(NB2WProduct):
         self.extra_metadata = extra_metadata
         metadata = encoded_data.get('meta_data', {})
         self.out_dir = out_dir
-        numpy_data_prod = NumpyDataProduct.decode(encoded_data)
+        numpy_data_prod = decode_numpy_data_product(encoded_data)
         if not numpy_data_prod.name:
             numpy_data_prod.name = self.name
 
@@ -187,6 +371,56 @@ class NB2WNumpyDataProduct(NB2WProduct):
             file_dir=out_dir,
             file_name=f"{self.name}.fits")
 
+    # e.g. {'compression_type': 'RICE_1'}, set by the product query from the instrument options
+    fits_compression = None
+
+    def write(self):
+        if not self.fits_compression:
+            return super().write()
+
+        file_path = self.dispatcher_data_prod.file_path.path
+        hdul = compressed_hdu_list(self.dispatcher_data_prod.data.to_fits_hdu_list(), **self.fits_compression)
+        # written aside and moved, as the dispatcher does for the uncompressed files
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            hdul.writeto(f, overwrite=True)
+        shutil.move(f.name, file_path)
+        self.file_path = file_path
+
+
+def compressed_hdu_list(hdul, compression_type='RICE_1', quantize_level=None, tile_shape=None):
+    """
+    Copy of hdul with the images as tile-compressed extensions.
+    Floating point images are compressed losslessly (GZIP_2, not quantized),
+    unless a quantize_level is given.
+    The data of a primary HDU moves to the first extension, after an empty primary HDU.
+    """
+    from astropy.io import fits
+
+    compressed = fits.HDUList()
+    for hdu in hdul:
+        is_image = isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU))
+        if not is_image or hdu.data is None or hdu.data.ndim == 0:
+            compressed.append(hdu)
+            continue
+
+        header = hdu.header.copy()
+        for key in ['SIMPLE', 'EXTEND', 'XTENSION', 'PCOUNT', 'GCOUNT']:
+            header.remove(key, ignore_missing=True)
+        kwargs = {'compression_type': compression_type}
+        if hdu.data.dtype.kind == 'f':
+            if quantize_level is None:
+                kwargs = {'compression_type': 'GZIP_2', 'quantize_level': 0}
+            else:
+                kwargs['quantize_level'] = quantize_level
+        if tile_shape is not None:
+            kwargs['tile_shape'] = tuple(tile_shape)
+
+        if isinstance(hdu, fits.PrimaryHDU):
+            compressed.append(fits.PrimaryHDU())
+        name = None if hdu.name in ('', 'PRIMARY') else hdu.name
+        compressed.append(fits.CompImageHDU(data=hdu.data, header=header, name=name, **kwargs))
+    return compressed
+
 
 class NB2WParameterProduct(NB2WProduct):
     type_key = 'http://odahub.io/ontology#WorkflowParameter'
@@ -215,18 +449,53 @@ class NB2WParameterProduct(NB2WProduct):
     def get_html_draw(self):
         return {'image': {'div': f'<br>value: {self.parameter_obj.value}<br>uri: {self.type_key}', 'script': ''} }
 
-@lru_cache
-def parameter_products_factory(ontology: Ontology):
-    classes = []
-    for term in ontology.get_parprod_terms():
-        classes.append(type(f"{term.split('#')[-1]}Product", 
-                            (NB2WParameterProduct,), 
-                            {'type_key': term, 'ontology_object': ontology}))
-    return classes
+class ParameterProductRegistry:
+    """
+    Product classes of the ontology ParameterProduct terms. 
+    
+    The terms are looked up once per ontology source and version, 
+    and a class is created only once per term, so that the classes are shared
+    by all the product descriptions and don't accumulate in long-lived workers.
+    """
+    def __init__(self):
+        self._classes = {}
+        self._terms = {}
+        self._lock = Lock()
+
+    def get_classes(self, ontology_path, ontology: Ontology | None = None):
+        key = (ontology_path, ontology_version(ontology_path))
+        with self._lock:
+            terms = self._terms.get(key)
+            if terms is None:
+                if ontology is None:
+                    from oda_api.ontology_helper import Ontology
+                    ontology = Ontology(ontology_path)
+                terms = self._terms[key] = ontology.get_parprod_terms()
+                for term in terms:
+                    if term not in self._classes:
+                        self._classes[term] = type(f"{term.split('#')[-1]}Product", 
+                                                   (NB2WParameterProduct,), 
+                                                   {'type_key': term, 'ontology_object': ontology})
+            return [self._classes[term] for term in terms]
+
+    def get_class(self, term):
+        # class of a term known from a previous run (e.g. restored from the description cache)
+        with self._lock:
+            if term not in self._classes:
+                self._classes[term] = type(f"{term.split('#')[-1]}Product", 
+                                           (NB2WParameterProduct,), 
+                                           {'type_key': term, 'ontology_object': None})
+            return self._classes[term]
+
+parameter_products_registry = ParameterProductRegistry()
+
+def parameter_products_factory(ontology_path, ontology: Ontology | None = None):
+    return parameter_products_registry.get_classes(ontology_path, ontology)
         
 
 class NB2WBinaryProduct(NB2WProduct): 
     type_key = 'http://odahub.io/ontology#ODABinaryProduct'
+    api_passthrough = True
     
     def __init__(self, 
                  encoded_data, 
@@ -236,7 +505,9 @@ class NB2WBinaryProduct(NB2WProduct):
         self.out_dir = out_dir
         self.name = name
         self.extra_metadata = extra_metadata
+        from oda_api.data_products import BinaryProduct
         self.data_prod = BinaryProduct.decode(encoded_data)
+        from magic import from_buffer as mime_from_buffer
         self.mime_type = mime_from_buffer(self.data_prod.bin_data, mime=True)
     
     def write(self):
@@ -279,6 +550,7 @@ class NB2WProgressProduct(NB2WProduct):
 
 class NB2WPictureProduct(NB2WProduct): 
     type_key = 'http://odahub.io/ontology#ODAPictureProduct'  
+    api_passthrough = True
     
     def __init__(self, 
                  encoded_data, 
@@ -288,6 +560,7 @@ class NB2WPictureProduct(NB2WProduct):
         self.name = name
         self.extra_metadata = extra_metadata
         self.out_dir = out_dir
+        from oda_api.data_products import PictureProduct
         self.data_prod = PictureProduct.decode(encoded_data)
         if not self.data_prod.name:
             self.data_prod.name = self.name
@@ -305,6 +578,7 @@ class NB2WPictureProduct(NB2WProduct):
 
 class NB2WAstropyTableProduct(NB2WProduct):
     type_key = 'http://odahub.io/ontology#ODAAstropyTable'
+    api_passthrough = True
     
     def __init__(self, 
                  encoded_data, 
@@ -315,6 +589,7 @@ class NB2WAstropyTableProduct(NB2WProduct):
         self.extra_metadata = extra_metadata
         metadata = encoded_data.get('meta_data', {})
         self.out_dir = out_dir
+        from oda_api.data_products import ODAAstropyTable
         table_data_prod = ODAAstropyTable.decode(encoded_data)
         if not table_data_prod.name:
             table_data_prod.name = self.name
@@ -322,6 +597,14 @@ class NB2WAstropyTableProduct(NB2WProduct):
                                                  table_data = table_data_prod,
                                                  meta_data=metadata,
                                                  file_dir = out_dir)
+
+    def set_table_format(self, table_format):
+        if table_format != self.dispatcher_data_prod.table_format:
+            self.dispatcher_data_prod = TableProduct(name = self.name,
+                                                     table_data = self.dispatcher_data_prod.table_data,
+                                                     meta_data = self.dispatcher_data_prod.meta_data,
+                                                     file_dir = self.out_dir,
+                                                     table_format = table_format)
     
     def get_html_draw(self):
         with StringIO() as sio:
@@ -0,0 +1,89 @@
+import cProfile
+import linecache
+import logging
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+from .util import get_request_argument, get_token_roles
+
+logger = logging.getLogger(__name__)
+
+
+def get_profiling_conf():
+    from .exposer import static_config_dict
+    return static_config_dict.get('profiling', {})
+
+
+def profiling_requested(instrument):
+    profiling_conf = get_profiling_conf()
+    if profiling_conf.get('enabled', False):
+        return True
+
+    request_parameter = profiling_conf.get('request_parameter')
+    if not request_parameter:
+        return False
+    if str(get_request_argument(request_parameter, '')).lower() not in ['1', 'true', 'yes']:
+        return False
+
+    allowed_roles = set(profiling_conf.get('roles', ['oda workflow developer']))
+    if allowed_roles & set(get_token_roles(instrument)):
+        return True
+
+    logger.warning('Profiling requested with "%s", but the token lacks any of the roles %s',
+                   request_parameter, sorted(allowed_roles))
+    return False
+
+
+def _write_top_allocations(snapshot, peak_memory, file_path, limit):
+    with open(file_path, 'w') as fd:
+        fd.write(f'peak traced memory: {peak_memory / 2**20:.2f} MiB\n')
+        fd.write(f'top {limit} allocations by line:\n')
+        for i, stat in enumerate(snapshot.statistics('lineno')[:limit], 1):
+            frame = stat.traceback[0]
+            fd.write(f'#{i}: {frame.filename}:{frame.lineno}: {stat.size / 2**10:.1f} KiB in {stat.count} blocks\n')
+            line = linecache.getline(frame.filename, frame.lineno).strip()
+            if line:
+                fd.write(f'    {line}\n')
+
+
+@contextmanager
+def profiled(stage, instrument, out_dir):
+    """
+    Runs the stage under cProfile and tracemalloc if profiling is enabled in the plugin config,
+    or requested with the configured request parameter by a privileged user.
+    The profile and the top allocations are written into out_dir, alongside the products.
+    """
+    if out_dir is None or not profiling_requested(instrument):
+        yield
+        return
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+
+        try:
+            profile_path = os.path.join(out_dir, f'nb2w_profile_{stage}.prof')
+            profiler.dump_stats(profile_path)
+            with open(os.path.join(out_dir, f'nb2w_profile_{stage}.txt'), 'w') as fd:
+                pstats.Stats(profiler, stream=fd).sort_stats('cumulative').print_stats(50)
+            _write_top_allocations(snapshot,
+                                   peak_memory,
+                                   os.path.join(out_dir, f'nb2w_allocations_{stage}.txt'),
+                                   get_profiling_conf().get('top_allocations', 25))
+            logger.info('Profile of %s written to %s', stage, profile_path)
+        except OSError as e:
+            logger.warning('Unable to write the profile of %s to %s: %s', stage, out_dir, e)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+from .metrics import registry as metrics
+
+# start of the cells in the notebook HTML made by nbconvert
+_cell_start = re.compile(r'<div class="(?:[^"]* )?jp-Notebook-cell[ "][^>]*>')
+_prompt_count = re.compile(r'\[\s*(\d+)\s*\]')
+
+
+class _CellParser(HTMLParser):
+    """
+    Execution count, tags and output text of one notebook cell
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.cell_id = None
+        self.tags = []
+        self.prompt = ''
+        self.outputs = []
+        self._depth = 0
+        self._prompt_depth = None
+        self._output_depth = None
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip += 1
+        if tag != 'div':
+            if tag == 'img' and self._output_depth is not None:
+                self.outputs[-1][1].append('[image]')
+            return
+        self._depth += 1
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if self._depth == 1:
+            self.cell_id = (attrs.get('id') or '').replace('cell-id=', '') or None
+            self.tags = [c[len('celltag_'):] for c in classes if c.startswith('celltag_')]
+        elif 'jp-InputPrompt' in classes:
+            self._prompt_depth = self._depth
+        elif 'jp-OutputArea-output' in classes and self._output_depth is None:
+            self._output_depth = self._depth
+            self.outputs.append((attrs.get('data-mime-type'), []))
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style'):
+            self._skip = max(0, self._skip - 1)
+        if tag != 'div':
+            return
+        if self._depth == self._prompt_depth:
+            self._prompt_depth = None
+        if self._depth == self._output_depth:
+            self._output_depth = None
+        self._depth -= 1
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._prompt_depth is not None:
+            self.prompt += data
+        elif self._output_depth is not None:
+            self.outputs[-1][1].append(data)
+
+
+def _parse_cell(cell_html, output_chars):
+    parser = _CellParser()
+    parser.feed(cell_html)
+    parser.close()
+
+    match = _prompt_count.search(parser.prompt)
+    execution_count = int(match.group(1)) if match else None
+    texts = [''.join(parts).strip() for _, parts in parser.outputs]
+    output = '\n'.join(text for text in texts if text)
+    failed = any(mime == 'application/vnd.jupyter.stderr' and 'Traceback' in ''.join(parts)
+                 for mime, parts in parser.outputs)
+
+    cell = {'id': parser.cell_id,
+            'status': 'failed' if failed else ('completed' if execution_count is not None else 'pending'),
+            'execution_count': execution_count,
+            'tags': parser.tags,
+            # the end of the output tells the most about the progress
+            'output': output[-output_chars:] if output_chars else '',
+            'output_truncated': len(output) > output_chars}
+    return cell
+
+
+class ProgressCompactor:
+    """
+    The trace of a running job (the notebook HTML) as a compact list of cells,
+    with their status, execution count, the time they were first seen completed,
+    and the end of their output, truncated to output_chars.
+
+    The cells are kept per job, and only the cells whose HTML changed since
+    the previous poll are parsed again. If the compact progress exceeds max_size
+    characters, the outputs of the earliest cells are dropped, then the earliest cells.
+    """
+    def __init__(self, max_jobs=1024):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compact(self, html, job_key=None, output_chars=256, max_size=65536):
+        html_digest = hashlib.sha256(html.encode()).hexdigest()
+        with self._lock:
+            job = self._jobs.get(job_key) if job_key is not None else None
+            if job is not None:
+                self._jobs.move_to_end(job_key)
+        if job is None:
+            job = {'digest': None, 'result': None, 'cells': {}, 'options': None}
+        elif job['digest'] == html_digest and job['options'] == (output_chars, max_size):
+            metrics.inc('progress_compaction_reused')
+            return job['result']
+
+        with metrics.timer('progress_compaction'):
+            starts = [m.start() for m in _cell_start.finditer(html)]
+            end = html.rfind('</main>')
+            if end < 0:
+                end = len(html)
+            cells = []
+            previous_cells = job['cells']
+            now = time.time()
+            for i, start in enumerate(starts):
+                cell_html = html[start:starts[i + 1] if i + 1 < len(starts) else end]
+                cell_digest = hashlib.sha256(cell_html.encode()).hexdigest()
+                previous = previous_cells.get(i)
+                if previous is not None and previous[0] == cell_digest and job['options'] == (output_chars, max_size):
+                    cell = previous[1]
+                else:
+                    cell = _parse_cell(cell_html, output_chars)
+                    completed_at = previous[1].get('completed_at') if previous is not None else None
+                    if cell['status'] != 'pending':
+                        cell['completed_at'] = completed_at or now
+                    previous_cells[i] = (cell_digest, cell)
+                cells.append(dict(cell, index=i))
+
+            result = {'format': 'cells', 'cells': cells, 'omitted_cells': 0}
+            self._limit_size(result, max_size)
+
+        job.update(digest=html_digest, result=result, options=(output_chars, max_size))
+        if job_key is not None:
+            with self._lock:
+                self._jobs[job_key] = job
+                self._jobs.move_to_end(job_key)
+                while len(self._jobs) > self.max_jobs:
+                    self._jobs.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _limit_size(result, max_size):
+        if not max_size:
+            return
+        cells = result['cells']
+        sizes = [len(json.dumps(cell)) for cell in cells]
+        total = sum(sizes) + 64
+        for i, cell in enumerate(cells):
+            if total <= max_size:
+                return
+            if cell['output']:
+                cells[i] = dict(cell, output='', output_truncated=True)
+                new_size = len(json.dumps(cells[i]))
+                total -= sizes[i] - new_size
+                sizes[i] = new_size
+        while total > max_size and cells:
+            total -= sizes.pop(0)
+            cells.pop(0)
+            result['omitted_cells'] += 1
+
+
+progress_compactor = ProgressCompactor()
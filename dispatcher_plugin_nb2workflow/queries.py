@@ -8,15 +8,24 @@ from .products import (NB2WProduct,
                        NB2WParameterProduct,
                        NB2WProgressProduct,
                        NB2WNumpyDataProduct,
-                       NB2WImageProduct)
-from oda_api.ontology_helper import Ontology
+                       NB2WImageProduct,
+                       NB2WEncodedProduct,
+                       available_table_format,
+                       decoded_products)
 import os
 from functools import lru_cache
-from copy import deepcopy
-from .util import with_hashable_dict
+from .util import with_hashable_dict, response_json, copy_parameter, get_request_argument
+from .metrics import registry as metrics
+from .profiling import profiled
+from .description_cache import description_cache
+from .archive import open_download_archive
+from .product_store import product_store
+from .progress import progress_compactor
 
 @with_hashable_dict
 @lru_cache
+@description_cache.cached('parameters')
+@metrics.timed('parameter_lists_construction')
 def construct_parameter_lists(bk_descript_dict = {}, ontology_path = None):
     src_query_pars_uris = { "http://odahub.io/ontology#PointOfInterestRA": "RA",
                             "http://odahub.io/ontology#PointOfInterestDEC": "DEC",
@@ -30,6 +39,8 @@ def construct_parameter_lists(bk_descript_dict = {}, ontology_path = None):
     # 1) if backend notebook defines parameter named "token", it will be renamed by general mechanism (appending "_rename")
     # 2) the actual token (represented as SourceQuery parameter "token") will be sent to backend as "_token" request argument
     
+    from oda_api.ontology_helper import Ontology
+
     plist = []
     source_plist = []
     for pname, pval in bk_descript_dict.items():
@@ -78,14 +89,14 @@ class NB2WSourceQuery(BaseQuery):
         parameters_dict = {}
         for product_name in product_names:
             backend_param_dict = backend_options[product_name]['parameters']
-            prod_source_plist = deepcopy(
-                construct_parameter_lists(
+            prod_source_plist = construct_parameter_lists(
                     bk_descript_dict=backend_param_dict, 
                     ontology_path=ontology_path
-                    )['source_plist'])
+                    )['source_plist']
             for par in prod_source_plist:
                 parameters_dict[par.name] = par
-        parameters_list = list(parameters_dict.values())
+        # only the kept parameters are copied
+        parameters_list = [copy_parameter(par) for par in parameters_dict.values()]
         try:
             token = Name(name_format='str', name='token', value=None, is_optional=True)
         except TypeError:
@@ -103,7 +114,12 @@ class NB2WProductQuery(ProductQuery):
             bk_descript_dict=backend_param_dict, 
             ontology_path=ontology_path)
         self.par_name_substitution = parameter_lists['par_name_substitution']
-        plist = deepcopy(parameter_lists['prod_plist'])
+        # dispatcher names of the parameters sent to the backend, mapped to the backend names
+        self.backend_names = {pname: bk_pname for pname, bk_pname in self.par_name_substitution.items()
+                              if bk_pname.startswith('_') or bk_pname in backend_param_dict}
+        self.backend_names.update({bk_pname: bk_pname for bk_pname in backend_param_dict
+                                   if bk_pname not in self.par_name_substitution})
+        plist = [copy_parameter(par) for par in parameter_lists['prod_plist']]
         self.ontology_path = ontology_path
         super().__init__(name, parameters_list = plist)
 
@@ -120,14 +136,35 @@ class NB2WProductQuery(ProductQuery):
         return qlist, qdict
 
 
-    def get_data_server_query(self, instrument, config=None, **kwargs):
+    def _instrument_parameters_index(self, instrument):
+        # same resolution as instrument.get_par_by_name(name, prod_name=...) for all the names at once:
+        # the last parameter with the name, within a query and across the queries
+        queries = getattr(instrument, '_queries_list', None)
+        if queries is None:
+            return {param_name: instrument.get_par_by_name(param_name, prod_name = self.backend_product_name)
+                    for param_name in instrument.get_parameters_name_list(prod_name = self.backend_product_name)}
+
+        index = {}
+        for _query in queries:
+            if isinstance(_query, ProductQuery) and _query.name != self.name:
+                continue
+            for par in _query.parameters:
+                index[par.name] = par
+        return index
+
+    def backend_param_dict_from_instrument(self, instrument):
         param_dict = {}
-        for param_name in instrument.get_parameters_name_list(prod_name = self.backend_product_name):
-            param_instance = instrument.get_par_by_name(param_name, prod_name = self.backend_product_name)
-            bk_pname = self.par_name_substitution.get(param_name, param_name)
-            if bk_pname.startswith('_') or bk_pname in self.backend_param_dict:
-                # should not send a source parameter if it's not in notebook
+        for param_name, param_instance in self._instrument_parameters_index(instrument).items():
+            bk_pname = self.backend_names.get(param_name)
+            if bk_pname is None and param_name.startswith('_') and param_name not in self.par_name_substitution:
+                bk_pname = param_name
+            # should not send a source parameter if it's not in notebook
+            if bk_pname is not None:
                 param_dict[bk_pname] = param_instance.get_default_value()
+        return param_dict
+
+    def get_data_server_query(self, instrument, config=None, **kwargs):
+        param_dict = self.backend_param_dict_from_instrument(instrument)
 
         return instrument.data_server_query_class(instrument=instrument,
                                                 config=config,
@@ -135,46 +172,142 @@ class NB2WProductQuery(ProductQuery):
                                                 task=self.backend_product_name)
 
     def build_product_list(self, instrument, res, out_dir, api=False):
-        prod_list = []
-        _output = None
         if out_dir is None:
             out_dir = './'
+        with profiled('build_product_list', instrument, out_dir):
+            return self._build_product_list(instrument, res, out_dir, api=api)
+
+    def _build_product_list(self, instrument, res, out_dir, api=False):
+        prod_list = []
+        _output = None
         res_progress_product = False
         # In the case of a dispatcher request where the progress of the execution has been requested
         # (`return_progress: True`), the get_progress_run wraps the response from the nb2service within a dict,
         # so that it is easier here to understand how to treat the response, and build the correct product list.
         # In case of a standard request then the res argument is expected to be a Response object with the content in
         # json format.
+        partial_output = None
+        jobdir = None
         if isinstance(res, dict):
             res_progress_product = res.get('progress_product', False)
+            # outputs already complete while the job is running
+            partial_output = res.get('partial_output', None)
+            jobdir = res.get('jobdir', None)
             res = res.get('res', None)
+        passthrough = api and self._api_passthrough(instrument)
         if res is not None:
             res_content_type = res.headers.get('content-type', None)
             if res_content_type is not None and res_content_type == 'application/json':
-                if 'output' in res.json().keys(): # in synchronous mode
-                    _o_dict = res.json()
+                with metrics.timer('backend_json_parse',
+                                   instrument=getattr(instrument, 'name', None),
+                                   product=self.backend_product_name):
+                    res_json = response_json(res)
+                if 'output' in res_json.keys(): # in synchronous mode
+                    _o_dict = res_json
                 else:
-                    _o_dict = res.json()['data']
+                    _o_dict = res_json['data']
                 _output = _o_dict['output']
-                prod_list = NB2WProduct.prod_list_factory(self.backend_output_dict, _output, out_dir, self.ontology_path)
+                # the products already delivered while the job was running are reused
+                cache_scope = self._cache_scope(instrument, _o_dict.get('jobdir'), out_dir)
+                if cache_scope is not None and not decoded_products.has_scope(cache_scope):
+                    # nothing to reuse, the scope is only released
+                    decoded_products.drop_scope(cache_scope)
+                    cache_scope = None
+                prod_list = NB2WProduct.prod_list_factory(self.backend_output_dict, 
+                                                          _output, 
+                                                          out_dir, 
+                                                          self.ontology_path,
+                                                          passthrough=passthrough,
+                                                          cache_scope=cache_scope)
             else:
                 _o_text = res.content.decode()
                 if res_progress_product:
-                    prod_list.append(NB2WProgressProduct(_o_text, out_dir))
+                    if self._requested_option(instrument, 'progress_format', 'html') == 'cells':
+                        prod_list.append(NB2WProgressProduct(self._compact_progress(instrument, _o_text, jobdir), out_dir))
+                    else:
+                        prod_list.append(NB2WProgressProduct(_o_text, out_dir))
+                    if partial_output:
+                        prod_list.extend(NB2WProduct.prod_list_factory(self.backend_output_dict,
+                                                                       partial_output,
+                                                                       out_dir,
+                                                                       self.ontology_path,
+                                                                       passthrough=passthrough,
+                                                                       partial=True,
+                                                                       cache_scope=self._cache_scope(instrument, jobdir, out_dir)))
 
         return prod_list
 
+    @classmethod
+    def _compact_progress(cls, instrument, html, jobdir):
+        cells_conf = cls._instrument_option(instrument, 'progress_cells') or {}
+        job_key = (getattr(instrument, 'name', None), jobdir.split('/')[-1]) if jobdir is not None else None
+        return progress_compactor.compact(html,
+                                          job_key=job_key,
+                                          output_chars=cells_conf.get('output_chars', 256),
+                                          max_size=cells_conf.get('max_size', 65536))
+
+    @staticmethod
+    def _cache_scope(instrument, jobdir, out_dir):
+        if jobdir is None:
+            return None
+        return (getattr(instrument, 'name', None), jobdir.split('/')[-1], out_dir)
+
+    @staticmethod
+    def _instrument_option(instrument, key, default=None):
+        from .exposer import get_instrument_option
+        return get_instrument_option(getattr(instrument, 'name', None), key, default)
+
+    @classmethod
+    def _requested_option(cls, instrument, key, default=None):
+        # the request may choose e.g. the table format with the _table_format argument
+        return get_request_argument(f'_{key}') or cls._instrument_option(instrument, key, default)
+
+    @staticmethod
+    def _binary_encoded_table(encoded_data):
+        # the backend sends the tables as ECSV text, unless they are already pickled
+        if isinstance(encoded_data, dict) and encoded_data.get('binary'):
+            return encoded_data
+        from oda_api.data_products import ODAAstropyTable
+        return ODAAstropyTable.decode(encoded_data).encode(use_binary=True)
+
+    @classmethod
+    def _api_passthrough(cls, instrument):
+        return cls._instrument_option(instrument, 'api_passthrough', False)
+
     def process_product_method(self, instrument, prod_list, api=False):
+        out_dir = getattr(prod_list.prod_list[0], 'out_dir', None) if prod_list.prod_list else None
+        with profiled('process_product_method', instrument, out_dir):
+            return self._process_product_method(instrument, prod_list, api=api)
+
+    def _process_product_method(self, instrument, prod_list, api=False):
         query_out = QueryOutput()
 
 
         np_dp_list, bin_dp_list, tab_dp_list, bin_im_dp_list, text_dp_list, progress_dp_list = [], [], [], [], [], []
         if api is True:
+            # the tables may be sent pickled, which oda_api reads without parsing text;
+            # unpickling runs arbitrary code, so the clients should only read them from trusted dispatchers
+            binary_tables = self._requested_option(instrument, 'api_table_encoding', 'ascii') == 'binary'
+            tab_bin_dp_list = []
             extra_meta = {}
             prod_uris = {}
             for product in prod_list.prod_list:
-                if isinstance(product, NB2WAstropyTableProduct):
-                    tab_dp_list.append(product.dispatcher_data_prod.table_data)
+                if (isinstance(product, NB2WEncodedProduct) and binary_tables 
+                        and issubclass(product.product_class, NB2WAstropyTableProduct)):
+                    tab_bin_dp_list.append(self._binary_encoded_table(product.encoded_data))
+                elif isinstance(product, NB2WEncodedProduct):
+                    for product_class, dp_list in [(NB2WAstropyTableProduct, tab_dp_list),
+                                                   (NB2WBinaryProduct, bin_dp_list),
+                                                   (NB2WPictureProduct, bin_im_dp_list),
+                                                   (NB2WNumpyDataProduct, np_dp_list)]:
+                        if issubclass(product.product_class, product_class):
+                            dp_list.append(product.encoded_data)
+                            break
+                elif isinstance(product, NB2WAstropyTableProduct):
+                    if binary_tables:
+                        tab_bin_dp_list.append(product.dispatcher_data_prod.table_data.encode(use_binary=True))
+                    else:
+                        tab_dp_list.append(product.dispatcher_data_prod.table_data)
                 elif isinstance(product, NB2WBinaryProduct):
                     bin_dp_list.append(product.data_prod)
                 elif isinstance(product, NB2WPictureProduct):
@@ -199,6 +332,8 @@ class NB2WProductQuery(ProductQuery):
 
             query_out.prod_dictionary['numpy_data_product_list'] = np_dp_list
             query_out.prod_dictionary['astropy_table_product_ascii_list'] = tab_dp_list
+            if binary_tables:
+                query_out.prod_dictionary['astropy_table_product_binary_list'] = tab_bin_dp_list
             query_out.prod_dictionary['binary_data_product_list'] = bin_dp_list
             query_out.prod_dictionary['binary_image_product_list'] = bin_im_dp_list
             query_out.prod_dictionary['text_product_list'] = text_dp_list
@@ -209,23 +344,64 @@ class NB2WProductQuery(ProductQuery):
             extra_meta = {}
             prod_uris = {}
 
-            for product in prod_list.prod_list:
-                if not isinstance(product, NB2WProgressProduct):
-                    html_draw = product.get_html_draw()
-                    product.write()
-                    try:
-                        file_name_list.append(os.path.basename(product.file_path))
-                    except AttributeError:
-                        pass
-                    if html_draw:
-                        image_list.append(html_draw)
-                else:
-                    html_draw = product.progress_data
-                    progress_product_list.append(html_draw)
+            instr_name = getattr(instrument, 'name', None)
+            table_format = available_table_format(self._requested_option(instrument, 'table_format', 'ecsv'))
+            fits_compression = self._instrument_option(instrument, 'fits_compression')
+            archive = None
+            # the partial products delivered with the progress are not archived,
+            # the archive is written once, with the final products
+            if (sum(not isinstance(product, NB2WProgressProduct) for product in prod_list.prod_list) > 1
+                    and not any(isinstance(product, NB2WProgressProduct) for product in prod_list.prod_list)):
+                archive = open_download_archive(getattr(prod_list.prod_list[0], 'out_dir', None),
+                                                f'{self.backend_product_name}.tar.gz',
+                                                self._instrument_option(instrument, 'download_archive'))
+            try:
+                for product in prod_list.prod_list:
+                    if isinstance(product, NB2WAstropyTableProduct):
+                        product.set_table_format(table_format)
+                    elif isinstance(product, NB2WNumpyDataProduct):
+                        product.fits_compression = fits_compression
+                    if not isinstance(product, NB2WProgressProduct):
+                        with metrics.timer('html_render', instrument=instr_name, product=product.name):
+                            html_draw = product.get_html_draw()
+                        write_options = [table_format, fits_compression]
+                        if (getattr(product, 'write_options', None) == write_options
+                                and os.path.exists(product.file_path)):
+                            # reused from an earlier poll of the same job, already written
+                            metrics.inc('file_write_skipped', instrument=instr_name, product=product.name)
+                        else:
+                            with metrics.timer('file_write', instrument=instr_name, product=product.name):
+                                product_store.write(product, options=write_options)
+                            product.write_options = write_options
+                        try:
+                            file_name_list.append(os.path.basename(product.file_path))
+                        except AttributeError:
+                            pass
+                        else:
+                            if archive is not None:
+                                with metrics.timer('archive_add', instrument=instr_name, product=product.name):
+                                    archive.add(product.file_path)
+                        if html_draw:
+                            image_list.append(html_draw)
+                    else:
+                        html_draw = product.progress_data
+                        progress_product_list.append(html_draw)
 
-                prod_name_list.append(product.name)
-                extra_meta[product.name] = getattr(product, 'extra_metadata', {})
-                prod_uris[product.name] = getattr(product, 'type_key', None)
+                    prod_name_list.append(product.name)
+                    extra_meta[product.name] = getattr(product, 'extra_metadata', {})
+                    prod_uris[product.name] = getattr(product, 'type_key', None)
+
+                if archive is not None:
+                    if len(file_name_list) > 1:
+                        with metrics.timer('archive_close', instrument=instr_name, product=self.backend_product_name):
+                            archive.close()
+                        query_out.prod_dictionary['download_archive'] = os.path.basename(archive.path)
+                    else:
+                        archive.abort()
+            except Exception:
+                if archive is not None:
+                    archive.abort()
+                raise
 
             query_out.prod_dictionary['file_name'] = file_name_list
             query_out.prod_dictionary['image'] = image_list[0] if len(image_list) == 1 else image_list
@@ -233,15 +409,18 @@ class NB2WProductQuery(ProductQuery):
             query_out.prod_dictionary['extra_metadata'] = extra_meta
             query_out.prod_dictionary['prod_uris'] = prod_uris
             
-            if len(prod_list.prod_list) == 1 and isinstance(prod_list.prod_list[0], NB2WProgressProduct):
+            if progress_product_list:
                 query_out.prod_dictionary['progress_product_html_output'] = progress_product_list
-            else:
+            # with the progress, the products already complete while the job is running
+            if len(prod_list.prod_list) > len(progress_product_list):
                 if len(file_name_list) == 1:
                     query_out.prod_dictionary['download_file_name'] = f'{file_name_list[0]}.gz'
                 else:
                     query_out.prod_dictionary['download_file_name'] = f'{self.backend_product_name}.tar.gz'
             query_out.prod_dictionary['prod_process_message'] = ''
 
+        metrics.end_request(instrument=getattr(instrument, 'name', None), product=self.backend_product_name)
+
         return query_out
 
 class NB2WInstrumentQuery(InstrumentQuery):
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+
+from .metrics import registry as metrics
+from .shared_store import shared_store
+
+logger = logging.getLogger(__name__)
+
+
+class Replica:
+    __slots__ = ('url', 'outstanding', 'healthy', 'failures', 'retry_at')
+
+    def __init__(self, url):
+        self.url = url.strip('/')
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0.
+
+
+class ReplicaPool:
+    """
+    The replicas of an instrument backend.
+
+    A new job goes to the healthy replica with the fewest outstanding requests
+    (or, with the 'hash' policy, to the one selected by rendezvous hashing of the job key,
+    which gives the same choice in all the dispatcher workers).
+    Once a replica served a job, the following requests of the job (with the same affinity key,
+    or the jobdir aliased to it) go to the same replica. With the shared store, the bindings
+    are also seen by the other dispatcher workers.
+    Replicas failing max_failures times in a row are skipped, and probed again
+    after health_check_interval seconds.
+    """
+    def __init__(self, name, urls):
+        self.name = name
+        self.replicas = [Replica(url) for url in urls]
+        self.policy = 'least_outstanding'
+        self.max_failures = 1
+        self.health_check_interval = 30
+        self.health_check_timeout = 2
+        self.max_affinity_entries = 10000
+        self._affinity = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, policy='least_outstanding', max_failures=1, health_check_interval=30, health_check_timeout=2):
+        self.policy = policy
+        self.max_failures = max_failures
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+
+    @property
+    def urls(self):
+        return [r.url for r in self.replicas]
+
+    def _replica(self, url):
+        for replica in self.replicas:
+            if replica.url == url:
+                return replica
+        return None
+
+    def _remember(self, affinity_key, url):
+        self._affinity[affinity_key] = url
+        self._affinity.move_to_end(affinity_key)
+        while len(self._affinity) > self.max_affinity_entries:
+            self._affinity.popitem(last=False)
+
+    def _bound(self, affinity_key):
+        url = self._affinity.get(affinity_key)
+        if url is not None:
+            self._affinity.move_to_end(affinity_key)
+            return self._replica(url)
+        return None
+
+    def _shared_key(self, affinity_key):
+        return 'replica:{}:{}'.format(self.name,
+                                      hashlib.sha256(json.dumps(affinity_key, default=str).encode()).hexdigest())
+
+    def _shared_bound(self, affinity_key):
+        # bound in another worker
+        if affinity_key is None or not shared_store.enabled:
+            return None
+        url = shared_store.get(self._shared_key(affinity_key))
+        if url is None:
+            return None
+        with self._lock:
+            self._remember(affinity_key, url)
+        return self._replica(url)
+
+    def bind(self, affinity_key, replica):
+        if affinity_key is None or len(self.replicas) == 1:
+            return
+        with self._lock:
+            changed = self._affinity.get(affinity_key) != replica.url
+            self._remember(affinity_key, replica.url)
+        if changed and shared_store.enabled:
+            shared_store.put(self._shared_key(affinity_key), replica.url)
+
+    def alias(self, affinity_key, existing_key):
+        # e.g. the jobdir reported by the backend, for the job submitted with the existing key
+        with self._lock:
+            replica = self._bound(existing_key)
+        if replica is None:
+            replica = self._shared_bound(existing_key)
+        if replica is not None:
+            self.bind(affinity_key, replica)
+
+    def _probe(self, replica):
+        try:
+            res = requests.get(replica.url, timeout=self.health_check_timeout)
+            return res.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def _revive_expired(self):
+        now = time.time()
+        for replica in self.replicas:
+            if not replica.healthy and replica.retry_at <= now:
+                replica.retry_at = now + self.health_check_interval
+                if self._probe(replica):
+                    logger.info('Backend replica %s of %s is healthy again', replica.url, self.name)
+                    replica.healthy = True
+                    replica.failures = 0
+
+    def choose(self, affinity_key=None):
+        if len(self.replicas) == 1:
+            return self.replicas[0]
+
+        with self._lock:
+            replica = self._bound(affinity_key)
+        if replica is None:
+            replica = self._shared_bound(affinity_key)
+        if replica is not None:
+            return replica
+
+        self._revive_expired()
+        candidates = [r for r in self.replicas if r.healthy] or self.replicas
+        if self.policy == 'hash' and affinity_key is not None:
+            return max(candidates,
+                       key=lambda r: hashlib.sha256(f'{r.url} {affinity_key}'.encode()).digest())
+        with self._lock:
+            return min(candidates, key=lambda r: r.outstanding)
+
+    @contextmanager
+    def outstanding(self, replica):
+        with self._lock:
+            replica.outstanding += 1
+        try:
+            yield replica
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+
+    def mark_success(self, replica):
+        replica.failures = 0
+        replica.healthy = True
+
+    def mark_failure(self, replica):
+        with self._lock:
+            replica.failures += 1
+            if replica.healthy and replica.failures >= self.max_failures and len(self.replicas) > 1:
+                logger.warning('Backend replica %s of %s is unhealthy, skipping it for %s s',
+                               replica.url, self.name, self.health_check_interval)
+                replica.healthy = False
+                replica.retry_at = time.time() + self.health_check_interval
+                metrics.inc('replica_unhealthy', instrument=self.name, replica=replica.url)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_replica_pool(instr_name, data_server_url):
+    from .exposer import get_instrument_option
+
+    urls = [data_server_url] if isinstance(data_server_url, str) else list(data_server_url)
+    with _pools_lock:
+        pool = _pools.get(instr_name)
+        if pool is None or pool.urls != [url.strip('/') for url in urls]:
+            pool = _pools[instr_name] = ReplicaPool(instr_name, urls)
+    # without the shared store, the bindings are not seen by the other workers,
+    # which find the replica of a job by hashing its key instead
+    default_policy = 'least_outstanding' if shared_store.enabled else 'hash'
+    pool.configure(policy=get_instrument_option(instr_name, 'replica_routing', default_policy),
+                   max_failures=get_instrument_option(instr_name, 'replica_max_failures', 1),
+                   health_check_interval=get_instrument_option(instr_name, 'replica_health_check_interval', 30))
+    return pool
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import requests
+
+from .metrics import registry as metrics
+from .shared_store import shared_store
+
+logger = logging.getLogger(__name__)
+
+
+class ResultSpool:
+    """
+    Final results of the async jobs, read from a directory shared with the backend,
+    instead of being requested again from the backend once it notified the completion.
+
+    The backend writes the result of a job (the data of its get response) to
+    <path>/<jobdir>/<file_name>, moving it there when it is complete.
+    The job directory of a request is recorded when the backend reports it,
+    also in the shared store if it is configured, so that any worker can find it.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._jobdirs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shared_key(key):
+        return f'jobdir:{hashlib.sha256(key.encode()).hexdigest()}'
+
+    def remember(self, key, jobdir):
+        if jobdir is None:
+            return
+        jobdir = jobdir.split('/')[-1]
+        with self._lock:
+            if self._jobdirs.get(key) == jobdir:
+                return
+            self._jobdirs[key] = jobdir
+            self._jobdirs.move_to_end(key)
+            while len(self._jobdirs) > self.max_entries:
+                self._jobdirs.popitem(last=False)
+        if shared_store.enabled:
+            shared_store.put(self._shared_key(key), jobdir)
+
+    def jobdir(self, key):
+        with self._lock:
+            jobdir = self._jobdirs.get(key)
+        if jobdir is None and shared_store.enabled:
+            jobdir = shared_store.get(self._shared_key(key))
+        return jobdir
+
+    def read(self, spool_conf, key, instrument=None, product=None):
+        """
+        The spooled result of the job of the request, as a response of the get endpoint,
+        or None if it is not (yet) available
+        """
+        if not spool_conf or spool_conf.get('path') is None:
+            return None
+        jobdir = self.jobdir(key)
+        if jobdir is None:
+            return None
+
+        # the job directory is reported by the backend: the file must stay within the spool
+        root = os.path.realpath(spool_conf['path'])
+        file_path = os.path.realpath(os.path.join(root, jobdir, spool_conf.get('file_name', 'result.json')))
+        if os.path.dirname(file_path) == root or os.path.commonpath([root, file_path]) != root:
+            logger.warning('Spooled result path %s is outside of the job directories in %s', file_path, root)
+            return None
+        try:
+            with metrics.timer('spool_read', instrument=instrument, product=product):
+                with open(file_path, 'rb') as fd:
+                    data = fd.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning('Unable to read the spooled result %s: %s', file_path, e)
+            return None
+        metrics.inc('spool_results', instrument=instrument, product=product)
+
+        res = requests.models.Response()
+        res.status_code = 200
+        res.headers['content-type'] = 'application/json'
+        res.encoding = 'utf-8'
+        res.url = file_path
+        res._content = b'{"workflow_status":"done","data":' + data + b'}'
+        return res
+
+
+result_spool = ResultSpool()
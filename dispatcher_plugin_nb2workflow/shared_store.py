@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+schema_version = 1
+
+
+class SharedStore:
+    """
+    Values shared by the dispatcher workers of a host (backend options, KG snapshot,
+    parsed descriptions), in a local SQLite database.
+
+    Every entry carries a version, incremented at each refresh, and its update time.
+    When an entry is missing or older than its ttl, the worker acquiring the entry lock file
+    refreshes it, while the others keep using the stale value, or wait for the refresh
+    if there is none yet. The database is cleared when written by a different code version.
+    """
+    def __init__(self):
+        self.path = None
+        self.ttl = 300
+        self.lock_timeout = 60
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, store_conf):
+        store_conf = store_conf or {}
+        self.path = store_conf.get('path')
+        self.ttl = store_conf.get('ttl', 300)
+        self.lock_timeout = store_conf.get('lock_timeout', 60)
+        self._local = threading.local()
+        if self.path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._check_schema()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(key TEXT PRIMARY KEY, version INTEGER, updated REAL, value BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._local.conn = conn
+        return conn
+
+    def _check_schema(self):
+        from .description_cache import code_version
+
+        stamp = f'{schema_version} {code_version()}'
+        conn = self._connection()
+        with self._lock_file('schema'):
+            row = conn.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+            if row is None or row[0] != stamp:
+                # the pickled values may not be compatible with this code
+                conn.execute('DELETE FROM entries')
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,))
+
+    def get_entry(self, key):
+        """
+        Returns (value, version, updated) or None
+        """
+        row = self._connection().execute('SELECT value, version, updated FROM entries WHERE key = ?',
+                                         (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0]), row[1], row[2]
+        except Exception as e:
+            logger.warning('Unable to load the shared %s: %s', key, e)
+            return None
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def put(self, key, value):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning('Unable to share %s: %s', key, e)
+            return
+        self._connection().execute('INSERT INTO entries VALUES (?, 1, ?, ?) '
+                                   'ON CONFLICT(key) DO UPDATE SET version = version + 1, '
+                                   'updated = excluded.updated, value = excluded.value',
+                                   (key, time.time(), blob))
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._connection().execute('DELETE FROM entries')
+        else:
+            self._connection().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def _lock_file(self, key):
+        return _FileLock(f'{self.path}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.lock',
+                         self.lock_timeout)
+
+    def get_or_refresh(self, key, refresh, ttl=None):
+        """
+        Returns the shared value of key, calling refresh() in one of the workers
+        if it is missing or expired. refresh() returning None means that the value
+        could not be obtained, and nothing is stored.
+        """
+        if not self.enabled:
+            return refresh()
+
+        ttl = self.ttl if ttl is None else ttl
+        entry = self.get_entry(key)
+        if entry is not None and time.time() - entry[2] < ttl:
+            return entry[0]
+
+        lock = self._lock_file(key)
+        if lock.acquire(blocking=entry is None):
+            try:
+                # refreshed by another worker while we were waiting
+                new_entry = self.get_entry(key)
+                if new_entry is not None and (entry is None or new_entry[1] != entry[1]):
+                    return new_entry[0]
+                value = refresh()
+                if value is not None:
+                    self.put(key, value)
+                    return value
+                return None if entry is None else entry[0]
+            finally:
+                lock.release()
+        if entry is not None:
+            # another worker is refreshing it
+            return entry[0]
+        logger.warning('Timeout waiting for the shared %s, obtaining it separately', key)
+        return refresh()
+
+
+class _FileLock:
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        if fcntl is None:
+            return True
+        self._fd = open(self.path, 'a')
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if not blocking or time.time() > deadline:
+                    self._fd.close()
+                    self._fd = None
+                    return False
+                time.sleep(0.05)
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+
+shared_store = SharedStore()
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# request arguments which are specific to the requesting user / dispatcher job
+# and do not change what the backend computes
+ignored_request_params = ['_token', '_async_request_callback']
+
+
+def request_key(instrument, url, params=None):
+    """
+    Canonical key of a backend request: instrument, endpoint and the sorted parameters,
+    leaving out the token and the callback url.
+    """
+    params = {k: v for k, v in (params or {}).items() if k not in ignored_request_params}
+    return json.dumps([instrument, url, params], sort_keys=True, default=str)
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlightGroup:
+    """
+    Coalesces identical concurrent calls, so that they share one execution.
+
+    Within a process the first caller of a key (the leader) runs the call,
+    while the others wait and receive the same result or exception.
+    With cross_worker enabled, the leaders of different processes are serialized
+    by a lock file in spool_dir, and the pickled result of the first one is reused
+    by those which were waiting for it.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.cross_worker = False
+        self.spool_dir = None
+        self.wait_timeout = 600
+        self.result_ttl = 60
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def configure(self, singleflight_conf):
+        singleflight_conf = singleflight_conf or {}
+        self.enabled = bool(singleflight_conf.get('enabled', True))
+        self.cross_worker = bool(singleflight_conf.get('cross_worker', False)) and fcntl is not None
+        self.spool_dir = singleflight_conf.get('spool_dir')
+        self.wait_timeout = singleflight_conf.get('wait_timeout', 600)
+        self.result_ttl = singleflight_conf.get('result_ttl', 60)
+        if self.cross_worker:
+            if self.spool_dir is None:
+                import tempfile
+                self.spool_dir = os.path.join(tempfile.gettempdir(), 'nb2w_singleflight')
+            os.makedirs(self.spool_dir, exist_ok=True)
+
+    def do(self, key, func):
+        """
+        Returns the result of func() and whether this caller actually executed it
+        """
+        if not self.enabled:
+            return func(), True
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+
+        if not leader:
+            if not flight.event.wait(self.wait_timeout):
+                logger.warning('Timeout waiting for the coalesced request, running it separately')
+                return func(), True
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+
+        try:
+            flight.result, leader = self._shared_call(key, func)
+            return flight.result, leader
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+            if flight.followers:
+                logger.debug('%s identical requests coalesced', flight.followers)
+
+    def _shared_call(self, key, func):
+        if not self.cross_worker:
+            return func(), True
+
+        started = time.time()
+        fn_base = os.path.join(self.spool_dir, hashlib.sha256(key.encode()).hexdigest())
+        with open(fn_base + '.lock', 'a') as lock_fd:
+            if not self._acquire(lock_fd):
+                logger.warning('Timeout waiting for the request lock, running the request separately')
+                return func(), True
+            try:
+                # some other worker completed the same request while we were waiting for the lock
+                try:
+                    if os.path.getmtime(fn_base + '.pkl') >= started:
+                        with open(fn_base + '.pkl', 'rb') as fd:
+                            return pickle.load(fd), False
+                except (OSError, pickle.PickleError, EOFError):
+                    pass
+
+                result = func()
+                self._store(fn_base + '.pkl', result)
+                return result, True
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def _acquire(self, lock_fd):
+        deadline = time.time() + self.wait_timeout
+        while True:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.time() > deadline:
+                    return False
+                time.sleep(0.05)
+
+    def _store(self, path, result):
+        try:
+            with atomic_write(path) as fd:
+                pickle.dump(result, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        except (OSError, pickle.PickleError, TypeError, AttributeError) as e:
+            logger.warning('Unable to share the request result: %s', e)
+        self._cleanup()
+
+    def _cleanup(self):
+        # the results are only useful to the workers waiting at the time they are stored
+        now = time.time()
+        try:
+            with os.scandir(self.spool_dir) as entries:
+                for entry in entries:
+                    try:
+                        # lock files are kept, removing one could let two workers hold "the" lock
+                        if entry.name.endswith('.pkl') and now - entry.stat().st_mtime > self.result_ttl:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+
+group = SingleFlightGroup()
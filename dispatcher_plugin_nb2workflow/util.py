@@ -1,7 +1,10 @@
 import logging
+import os
+import threading
+from copy import copy, deepcopy
 from html.parser import HTMLParser
 from functools import wraps
-from json import dumps
+from json import dumps, loads
 
 logger = logging.getLogger()
 
@@ -46,3 +49,104 @@ def with_hashable_dict(func):
                     bk_descript_dict=HashableDict(bk_descript_dict), 
                     ontology_path=ontology_path)
     return wrapper
+
+class atomic_write:
+    """
+    File written to a temporary name next to path, and moved to path when it is closed 
+    without error, so that it is never seen partially written. 
+    Used as a context manager, it gives the open file, or the temporary path if mode is None
+    (for the files which are not written through a file object, e.g. hard links).
+    """
+    def __init__(self, path, mode='wb'):
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        self.fd = open(self.tmp_path, mode) if mode is not None else None
+
+    def commit(self):
+        try:
+            if self.fd is not None:
+                self.fd.close()
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        if self.fd is not None:
+            self.fd.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self.fd if self.fd is not None else self.tmp_path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+
+_immutable_types = (str, bytes, int, float, complex, bool, type(None), tuple, frozenset)
+
+def copy_parameter(par):
+    """
+    Copy-on-write copy of a cached Parameter: the definition (units, formats, restrictions, 
+    ontology-derived data) is shared with the cached instance, while the value state,
+    which is set per request, is copied if it is mutable.
+    The copy is an instance of the same class, so it can be used wherever the original is.
+    """
+    new_par = copy(par)
+    for attr, val in vars(par).items():
+        if 'value' in attr and 'allowed' not in attr and not isinstance(val, _immutable_types):
+            setattr(new_par, attr, deepcopy(val))
+    return new_par
+
+def response_json(res):
+    # the parsed content is kept on the response, which may be shared by coalesced requests
+    try:
+        return res._nb2w_json
+    except AttributeError:
+        res._nb2w_json = res.json()
+        return res._nb2w_json
+
+def compact_json_value(value):
+    # structured parameter values arrive as JSON text, possibly indented
+    if isinstance(value, str) and value[:1] in ('[', '{'):
+        try:
+            return dumps(loads(value), separators=(',', ':'))
+        except ValueError:
+            pass
+    return value
+
+def get_request_argument(name, default=None):
+    # arguments of the dispatcher request, which are not declared as instrument parameters
+    try:
+        from flask import request, has_request_context
+    except ImportError:
+        return default
+    if not has_request_context():
+        return default
+    return request.values.get(name, default)
+
+def get_token_roles(instrument):
+    try:
+        token = instrument.get_par_by_name('token').value
+    except Exception:
+        return []
+    if not token:
+        return []
+    import jwt
+    from cdci_data_analysis.analysis.tokenHelper import get_token_roles as decoded_token_roles
+    # the token has already been validated by the dispatcher at this point
+    return decoded_token_roles(jwt.decode(token, options={'verify_signature': False}))
+
+def ontology_version(ontology_path):
+    # local files are versioned by their modification time and size; 
+    # remote ontologies are loaded once per process by oda_api, so the path identifies them
+    if ontology_path is not None and '://' not in ontology_path and os.path.isfile(ontology_path):
+        stat = os.stat(ontology_path)
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+    return 'remote'
@@ -17,6 +17,7 @@ import pytest
 import json
 import os
 import signal
+from textwrap import dedent
 from xprocess import ProcessStarter
 import requests
 from urllib.parse import urlparse, parse_qs
@@ -151,6 +152,28 @@ def conf_file_no_glued_output(tmp_path_factory):
     fn.write_text(config_one_instrument_no_glued_output)
     yield str(fn.resolve())
 
+@pytest.fixture
+def reload_plugin_conf(conf_file, dispatcher_live_fixture):
+    """
+    Rewrites the plugin config and reloads the plugin in the live dispatcher,
+    the original config is restored and reloaded after the test
+    """
+    with open(conf_file, 'r') as fd:
+        conf_bk = fd.read()
+
+    def reload(config):
+        with open(conf_file, 'w') as fd:
+            fd.write(dedent(config))
+        c = requests.get(dispatcher_live_fixture + "/reload-plugin/dispatcher_plugin_nb2workflow")
+        assert c.status_code == 200
+        return dispatcher_live_fixture
+
+    yield reload
+
+    with open(conf_file, 'w') as fd:
+        fd.write(conf_bk)
+    requests.get(dispatcher_live_fixture + "/reload-plugin/dispatcher_plugin_nb2workflow")
+
 # @pytest.fixture
 # def dispatcher_plugin_config_env(conf_file, monkeypatch):
 #     monkeypatch.setenv('CDCI_NB2W_PLUGIN_CONF_FILE', conf_file)
@@ -0,0 +1,102 @@
+import json
+import time
+
+import pytest
+from werkzeug.wrappers import Response
+
+
+def test_backend_admission_control(httpserver, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from dispatcher_plugin_nb2workflow import exposer
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    monkeypatch.setitem(exposer.static_config_dict, 'max_concurrent_requests', 1)
+    monkeypatch.setitem(exposer.static_config_dict, 'max_queued_requests', 0)
+
+    def slow_handler(request):
+        time.sleep(0.5)
+        return Response(json.dumps({'exceptions': [], 'jobdir': '/tmp/nb2w-adm', 'output': {}}),
+                        status=200,
+                        content_type='application/json')
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/slow').respond_with_handler(slow_handler)
+
+    dispatcher = NB2WDataDispatcher(instrument='example0')
+    # options are fetched before, so that only the product requests compete for the slot
+    assert dispatcher.backend_options == {}
+
+    def run(par):
+        return dispatcher.run_query(run_asynch=False, task='slow', param_dict={'par': par})[1]
+
+    with ThreadPoolExecutor(2) as pool:
+        query_outs = list(pool.map(run, [1, 2]))
+
+    assert sorted(qo.get_job_status() for qo in query_outs) == ['done', 'failed']
+    busy = [qo for qo in query_outs if qo.get_job_status() == 'failed'][0]
+    assert 'is busy' in busy.status_dictionary['message']
+
+
+def test_backend_options_when_backend_busy(httpserver, monkeypatch):
+    from dispatcher_plugin_nb2workflow import exposer
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher, _last_backend_options
+    from dispatcher_plugin_nb2workflow.admission import get_admission_controller
+
+    # no product request is admitted
+    monkeypatch.setitem(exposer.static_config_dict, 'max_concurrent_requests', 0)
+    monkeypatch.setitem(exposer.static_config_dict, 'max_queued_requests', 0)
+    monkeypatch.setitem(exposer.static_config_dict, 'queue_timeout', 0.1)
+    _last_backend_options.clear()
+
+    options_calls = []
+    def options_handler(request):
+        options_calls.append(request.url)
+        return Response(json.dumps({'lc': {'parameters': {}, 'output': {}}}),
+                        status=200,
+                        content_type='application/json')
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_handler(options_handler)
+
+    # the options are still obtained through the reserved slot, so that the instrument 
+    # has its product queries, and the product query reports the busy backend
+    assert list(NB2WDataDispatcher(instrument='example0').backend_options) == ['lc']
+    assert len(options_calls) == 1
+    _, query_out = NB2WDataDispatcher(instrument='example0').run_query(run_asynch=False, 
+                                                                       task='lc', 
+                                                                       param_dict={})
+    assert query_out.get_job_status() == 'failed'
+    assert 'is busy' in query_out.status_dictionary['message']
+
+    # when the reserved slot is taken too, the last options are used
+    with get_admission_controller('example0').slot(reserved=True):
+        assert list(NB2WDataDispatcher(instrument='example0').backend_options) == ['lc']
+    assert len(options_calls) == 1
+
+
+def test_admission_reserved_slot():
+    from concurrent.futures import ThreadPoolExecutor
+    from dispatcher_plugin_nb2workflow.admission import AdmissionController, BackendBusy
+
+    controller = AdmissionController('example0')
+    controller.configure(max_concurrent_requests=1, max_queued_requests=0, queue_timeout=0.2)
+
+    with controller.slot():
+        with pytest.raises(BackendBusy):
+            with controller.slot():
+                pass
+        # the reserved slot is taken by one request at a time, the next one waits for it
+        with controller.slot(reserved=True):
+            with pytest.raises(BackendBusy):
+                with controller.slot(reserved=True):
+                    pass
+
+        def reserved_request(delay):
+            time.sleep(delay)
+            with controller.slot(reserved=True):
+                time.sleep(0.1)
+            return True
+
+        with ThreadPoolExecutor(2) as pool:
+            assert list(pool.map(reserved_request, [0, 0.05])) == [True, True]
+
+    assert controller.active == 0 and controller.reserved_active == 0
@@ -0,0 +1,134 @@
+import gzip
+import json
+import os
+import time
+
+from werkzeug.wrappers import Response
+
+
+def test_compressed_backend_transfer(httpserver):
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+    from dispatcher_plugin_nb2workflow.metrics import registry
+
+    with open(os.path.join(os.path.dirname(__file__), 'responses', 'options.json'), 'rb') as fd:
+        options_content = fd.read()
+
+    def options_handler(request):
+        assert 'gzip' in request.headers.get('Accept-Encoding', '')
+        return Response(gzip.compress(options_content),
+                        status=200,
+                        content_type='application/json',
+                        headers={'Content-Encoding': 'gzip'})
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_handler(options_handler)
+
+    enabled = registry.enabled
+    registry.enabled = True
+    try:
+        raw_before = registry.counter('backend_transfer_bytes', instrument='example0', kind='raw')
+        decoded_before = registry.counter('backend_transfer_bytes', instrument='example0', kind='decoded')
+        backend_options = NB2WDataDispatcher(instrument='example0').backend_options
+        raw_after = registry.counter('backend_transfer_bytes', instrument='example0', kind='raw')
+        decoded_after = registry.counter('backend_transfer_bytes', instrument='example0', kind='decoded')
+    finally:
+        registry.enabled = enabled
+
+    assert backend_options == json.loads(options_content)
+    assert decoded_after - decoded_before == len(options_content)
+    assert raw_after - raw_before < len(options_content)
+
+
+def test_single_flight_backend_requests(httpserver):
+    from concurrent.futures import ThreadPoolExecutor
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    backend_calls = []
+    def slow_handler(request):
+        backend_calls.append(request.args.get('_token'))
+        time.sleep(0.5)
+        return Response(json.dumps({'exceptions': [], 'jobdir': '/tmp/nb2w-sf', 'output': {}}),
+                        status=200,
+                        content_type='application/json')
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/slow').respond_with_handler(slow_handler)
+
+    def run(token):
+        return NB2WDataDispatcher(instrument='example0').run_query(run_asynch=False,
+                                                                   task='slow',
+                                                                   param_dict={'par': 1, '_token': token})
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(run, ['token0', 'token1', 'token2', 'token3']))
+
+    assert len(backend_calls) == 1
+    assert all(query_out.get_job_status() == 'done' for _, query_out in results)
+    assert len(set(id(res) for res, _ in results)) == 1
+
+    # not coalesced when the parameters differ
+    backend_calls.clear()
+    NB2WDataDispatcher(instrument='example0').run_query(run_asynch=False, task='slow', param_dict={'par': 2})
+    assert len(backend_calls) == 1
+
+
+def test_single_flight_async_submissions_not_coalesced(httpserver):
+    from concurrent.futures import ThreadPoolExecutor
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    callbacks = []
+    def slow_handler(request):
+        callbacks.append(request.args.get('_async_request_callback'))
+        time.sleep(0.5)
+        return Response(json.dumps({'workflow_status': 'submitted', 'jobdir': '/tmp/nb2w-sf-async', 'comment': ''}),
+                        status=201,
+                        content_type='application/json')
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/slow').respond_with_handler(slow_handler)
+
+    def run(call_back_url):
+        return NB2WDataDispatcher(instrument='example0').run_query(run_asynch=True,
+                                                                   task='slow',
+                                                                   call_back_url=call_back_url,
+                                                                   param_dict={'par': 1})
+
+    callback_urls = ['http://dispatcher/call_back?job_id=0', 'http://dispatcher/call_back?job_id=1']
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(run, callback_urls))
+
+    # each job registers its own callback
+    assert sorted(callbacks) == callback_urls
+    assert all(query_out.get_job_status() == 'submitted' for _, query_out in results)
+
+
+def test_large_parameters_posted_to_backend(httpserver, monkeypatch):
+    from dispatcher_plugin_nb2workflow import exposer
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    monkeypatch.setitem(exposer.static_config_dict, 'post_params_threshold', 1000)
+
+    backend_calls = []
+    def handler(request):
+        backend_calls.append((request.method, 
+                              request.get_json() if request.method == 'POST' else request.args.to_dict()))
+        return Response(json.dumps({'exceptions': [], 'jobdir': '/tmp/nb2w-post', 'output': {}}),
+                        status=200,
+                        content_type='application/json')
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/lc').respond_with_handler(handler)
+
+    NB2WDataDispatcher(instrument='example0').run_query(run_asynch=False, task='lc', param_dict={'src_name': 'Crab'})
+    assert backend_calls[-1] == ('GET', {'src_name': 'Crab'})
+
+    sources = json.dumps([{'name': f'src{i}', 'ra': i, 'dec': -i} for i in range(100)], indent=4)
+    _, query_out = NB2WDataDispatcher(instrument='example0').run_query(run_asynch=False,
+                                                                       task='lc',
+                                                                       param_dict={'sources': sources,
+                                                                                   'radius': None})
+    assert query_out.get_job_status() == 'done'
+    method, body = backend_calls[-1]
+    assert method == 'POST'
+    assert body['radius'] == '\x00'
+    assert json.loads(body['sources']) == json.loads(sources)
+    assert ' ' not in body['sources'] and '\n' not in body['sources']
@@ -0,0 +1,87 @@
+import json
+import os
+
+
+def test_parameter_products_registry():
+    from cdci_data_analysis.analysis.parameters import subclasses_recursive
+    from dispatcher_plugin_nb2workflow.exposer import ontology_path
+    from dispatcher_plugin_nb2workflow.products import (NB2WProduct, 
+                                                        NB2WParameterProduct, 
+                                                        parameter_products_factory)
+
+    classes = parameter_products_factory(ontology_path)
+    assert len(classes) > 0
+    n_classes = len(subclasses_recursive(NB2WParameterProduct))
+
+    for i in range(3):
+        # every description is a cache miss of the analyser
+        descr = {f'number_{i}': {'name': f'number_{i}',
+                                 'owl_type': 'http://odahub.io/ontology#Integer',
+                                 'python_type': {'type_object': "<class 'int'>"},
+                                 'value': 1}}
+        prod_classes = NB2WProduct._prod_list_description_analyser(bk_descript_dict=descr, ontology_path=ontology_path)
+        assert prod_classes[f'number_{i}'][0] in classes
+
+    assert parameter_products_factory(ontology_path) == classes
+    assert len(subclasses_recursive(NB2WParameterProduct)) == n_classes
+
+
+def test_persistent_description_cache(tmp_path, monkeypatch):
+    from dispatcher_plugin_nb2workflow.description_cache import description_cache
+    from dispatcher_plugin_nb2workflow.exposer import ontology_path
+    from dispatcher_plugin_nb2workflow.products import NB2WProduct, NB2WAstropyTableProduct
+    from dispatcher_plugin_nb2workflow.queries import construct_parameter_lists
+
+    monkeypatch.setattr(description_cache, 'directory', str(tmp_path))
+
+    params_descr = {'seed': {'default_value': 42,
+                             'name': 'seed',
+                             'owl_type': 'http://odahub.io/ontology#Integer',
+                             'python_type': {'type_object': "<class 'int'>"},
+                             'value': 42}}
+    output_descr = {'number': {'name': 'number',
+                               'owl_type': 'http://odahub.io/ontology#Integer',
+                               'python_type': {'type_object': "<class 'int'>"},
+                               'value': 1},
+                    'table': {'name': 'table',
+                              'owl_type': 'http://odahub.io/ontology#ODAAstropyTable',
+                              'python_type': {'type_object': "<class 'str'>"},
+                              'value': ''}}
+
+    parameter_lists = construct_parameter_lists(bk_descript_dict=params_descr, ontology_path=ontology_path)
+    prod_classes = NB2WProduct._prod_list_description_analyser(bk_descript_dict=output_descr, ontology_path=ontology_path)
+    assert len(os.listdir(tmp_path)) == 2
+
+    # as in a fresh worker
+    construct_parameter_lists.__wrapped__.cache_clear()
+    NB2WProduct._prod_list_description_analyser.__wrapped__.cache_clear()
+
+    restored_lists = construct_parameter_lists(bk_descript_dict=params_descr, ontology_path=ontology_path)
+    restored_classes = NB2WProduct._prod_list_description_analyser(bk_descript_dict=output_descr, ontology_path=ontology_path)
+
+    assert [p.name for p in restored_lists['prod_plist']] == [p.name for p in parameter_lists['prod_plist']]
+    assert restored_lists['prod_plist'][0].value == 42
+    assert restored_classes['number'][0] is prod_classes['number'][0]
+    assert restored_classes['table'][0] is NB2WAstropyTableProduct
+
+
+def test_shared_backend_options(httpserver, tmp_path):
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+    from dispatcher_plugin_nb2workflow.shared_store import shared_store
+
+    with open(os.path.join(os.path.dirname(__file__), 'responses', 'options.json'), 'r') as fd:
+        options = json.loads(fd.read())
+    httpserver.expect_request('/api/v1.0/options').respond_with_json(options)
+
+    shared_store.configure({'path': str(tmp_path / 'shared.sqlite'), 'ttl': 300})
+    try:
+        for _ in range(3):
+            # a new dispatcher instance per query, as in the dispatcher
+            assert NB2WDataDispatcher(instrument='example0').backend_options == options
+        assert len([req for req, _ in httpserver.log if req.path == '/api/v1.0/options']) == 1
+        
+        value, version, _ = shared_store.get_entry("backend_options:example0:['http://localhost:8000']")
+        assert value == options
+        assert version == 1
+    finally:
+        shared_store.configure(None)
@@ -0,0 +1,57 @@
+import os
+
+
+def test_streaming_download_archive(tmp_path):
+    import tarfile
+    from dispatcher_plugin_nb2workflow.archive import open_download_archive
+
+    contents = {'lc.fits': os.urandom(100000),
+                'table.ecsv': b'# %ECSV 1.0\n' * 5000,
+                'empty.txt': b''}
+    for fn, data in contents.items():
+        (tmp_path / fn).write_bytes(data)
+
+    assert open_download_archive(str(tmp_path), 'lc query.tar.gz', {'enabled': False}) is None
+
+    archive = open_download_archive(str(tmp_path), 'lc query.tar.gz', {'enabled': True, 'threads': 3})
+    # several compressed blocks per file
+    archive.block_size = 16 * 1024
+    for fn in contents:
+        archive.add(str(tmp_path / fn))
+    archive.close()
+
+    assert archive.path == str(tmp_path / 'lc_query.tar.gz')
+    assert not [fn for fn in os.listdir(tmp_path) if fn.endswith('.tmp')]
+    with tarfile.open(archive.path, 'r:gz') as tar:
+        assert tar.getnames() == [f'lc_query/{fn}' for fn in contents]
+        for fn, data in contents.items():
+            assert tar.extractfile(f'lc_query/{fn}').read() == data
+
+
+def test_download_archive_not_written_with_progress(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from dispatcher_plugin_nb2workflow import exposer
+    from dispatcher_plugin_nb2workflow.queries import NB2WProductQuery
+    from dispatcher_plugin_nb2workflow.products import NB2WProgressProduct, NB2WTextProduct
+
+    query = NB2WProductQuery('lc_query', 'lc', {}, {}, None)
+    instrument = SimpleNamespace(name='example0')
+    products = [NB2WTextProduct(text, out_dir=str(tmp_path), name=text) for text in ['a', 'b']]
+
+    # not written unless it is enabled
+    monkeypatch.delitem(exposer.static_config_dict, 'download_archive', raising=False)
+    query_out = query.process_product_method(instrument, SimpleNamespace(prod_list=products))
+    assert 'download_archive' not in query_out.prod_dictionary
+    assert sorted(os.listdir(tmp_path)) == ['a', 'b']
+
+    monkeypatch.setitem(exposer.static_config_dict, 'download_archive', {'enabled': True})
+
+    # partial products delivered with the progress
+    query_out = query.process_product_method(instrument, 
+                                             SimpleNamespace(prod_list=[NB2WProgressProduct('<html/>', str(tmp_path))]
+                                                                       + products))
+    assert 'download_archive' not in query_out.prod_dictionary
+    assert sorted(os.listdir(tmp_path)) == ['a', 'b']
+
+    query_out = query.process_product_method(instrument, SimpleNamespace(prod_list=products))
+    assert query_out.prod_dictionary['download_archive'] == 'lc.tar.gz'
@@ -0,0 +1,52 @@
+import os
+
+
+def test_metrics_prometheus_export():
+    from dispatcher_plugin_nb2workflow.metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    with registry.timer('backend_request', instrument='example0', product='lightcurve'):
+        pass
+    assert 'nb2w_stage_duration_seconds' not in registry.render_prometheus()
+
+    registry.configure({'enabled': True})
+    with registry.timer('backend_request', instrument='example0', product='lightcurve'):
+        pass
+    registry.inc('backend_requests', instrument='example0', status=200)
+
+    exported = registry.render_prometheus()
+    assert 'nb2w_stage_duration_seconds_count{stage="backend_request",instrument="example0",product="lightcurve"} 1' in exported
+    assert 'nb2w_backend_requests_total{instrument="example0",status="200"} 1' in exported
+
+
+def test_metrics_timed_disabled():
+    from dispatcher_plugin_nb2workflow.metrics import MetricsRegistry
+
+    def stage():
+        return 1
+
+    registry = MetricsRegistry()
+    assert registry.timed('stage')(stage) is stage
+
+    registry.configure({'enabled': True})
+    timed_stage = registry.timed('stage')(stage)
+    assert timed_stage is not stage
+    assert timed_stage() == 1
+    assert 'nb2w_stage_duration_seconds_count{stage="stage"} 1' in registry.render_prometheus()
+
+
+def test_profiling_snapshots(tmp_path, monkeypatch):
+    from dispatcher_plugin_nb2workflow import exposer
+    from dispatcher_plugin_nb2workflow.profiling import profiled
+
+    with profiled('build_product_list', None, str(tmp_path)):
+        pass
+    assert os.listdir(tmp_path) == []
+
+    monkeypatch.setitem(exposer.static_config_dict, 'profiling', {'enabled': True})
+    with profiled('build_product_list', None, str(tmp_path)):
+        [bytes(1000) for _ in range(100)]
+
+    assert sorted(os.listdir(tmp_path)) == ['nb2w_allocations_build_product_list.txt',
+                                            'nb2w_profile_build_product_list.prof',
+                                            'nb2w_profile_build_product_list.txt']
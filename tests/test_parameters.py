@@ -0,0 +1,89 @@
+import json
+import os
+
+
+def test_parameter_copies_are_independent():
+    from dispatcher_plugin_nb2workflow.exposer import ontology_path
+    from dispatcher_plugin_nb2workflow.queries import NB2WProductQuery, construct_parameter_lists
+
+    params_descr = {'seed': {'default_value': 42,
+                             'name': 'seed',
+                             'owl_type': 'http://odahub.io/ontology#Integer',
+                             'python_type': {'type_object': "<class 'int'>"},
+                             'value': 42},
+                    'columns': {'default_value': ['a', 'b'],
+                                'name': 'columns',
+                                'owl_type': 'http://odahub.io/ontology#String',
+                                'python_type': {'type_object': "<class 'list'>"},
+                                'value': ['a', 'b']}}
+    
+    q0 = NB2WProductQuery('q_query', 'q', params_descr, {}, ontology_path)
+    q1 = NB2WProductQuery('q_query', 'q', params_descr, {}, ontology_path)
+    cached = construct_parameter_lists(bk_descript_dict=params_descr, ontology_path=ontology_path)['prod_plist']
+
+    p0, p1 = q0.get_par_by_name('seed'), q1.get_par_by_name('seed')
+    assert p0 is not p1
+    assert type(p0) is type(cached[0])
+
+    p0.value = 7
+    assert p1.value == 42
+    assert cached[0].value == 42
+
+    if isinstance(q0.get_par_by_name('columns').value, list):
+        q0.get_par_by_name('columns').value.append('c')
+        assert q1.get_par_by_name('columns').value == ['a', 'b']
+
+
+def test_data_server_query_parameters():
+    from cdci_data_analysis.analysis.instrument import Instrument
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+    from dispatcher_plugin_nb2workflow.exposer import ontology_path
+    from dispatcher_plugin_nb2workflow.queries import NB2WInstrumentQuery, NB2WProductQuery, NB2WSourceQuery
+
+    with open(os.path.join(os.path.dirname(__file__), 'responses', 'options.json'), 'r') as fd:
+        options = json.loads(fd.read())
+
+    query_list, query_dict = NB2WProductQuery.query_list_and_dict_factory(options, ontology_path)
+    instrument = Instrument('example0',
+                            src_query=NB2WSourceQuery.from_backend_options(options, ontology_path),
+                            instrumet_query=NB2WInstrumentQuery('instr_query', False),
+                            data_serve_conf_file=None,
+                            product_queries_list=query_list,
+                            query_dictionary=query_dict,
+                            asynch=True,
+                            data_server_query_class=NB2WDataDispatcher)
+
+    for query in query_list:
+        param_dict = query.backend_param_dict_from_instrument(instrument)
+        # the backend names of the product parameters, and the token
+        assert set(param_dict) == set(options[query.backend_product_name]['parameters']) | {'_token'}
+
+
+def test_data_server_query_duplicated_parameter():
+    from copy import copy
+    from cdci_data_analysis.analysis.instrument import Instrument
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+    from dispatcher_plugin_nb2workflow.exposer import ontology_path
+    from dispatcher_plugin_nb2workflow.queries import NB2WInstrumentQuery, NB2WProductQuery, NB2WSourceQuery
+
+    with open(os.path.join(os.path.dirname(__file__), 'responses', 'options.json'), 'r') as fd:
+        options = json.loads(fd.read())
+
+    query_list, query_dict = NB2WProductQuery.query_list_and_dict_factory(options, ontology_path)
+    instrument = Instrument('example0',
+                            src_query=NB2WSourceQuery.from_backend_options(options, ontology_path),
+                            instrumet_query=NB2WInstrumentQuery('instr_query', False),
+                            data_serve_conf_file=None,
+                            product_queries_list=query_list,
+                            query_dictionary=query_dict,
+                            asynch=True,
+                            data_server_query_class=NB2WDataDispatcher)
+
+    query = [q for q in query_list if q.backend_product_name == 'lightcurve'][0]
+    duplicate = copy(query.get_par_by_name('seed'))
+    query._parameters_list.append(duplicate)
+
+    index = query._instrument_parameters_index(instrument)
+    assert index['seed'] is duplicate
+    for param_name, param in index.items():
+        assert param is instrument.get_par_by_name(param_name, prod_name=query.backend_product_name)
@@ -323,6 +323,49 @@ def test_get_config_dict_from_kg():
     assert cdict['instruments']['kgunlab']['creativeWorkStatus'] == 'undefined'
     assert cdict['instruments']['kgprod']['creativeWorkStatus'] == 'production'
 
+def test_get_config_dict_from_kg_paged_and_filtered(caplog):
+    from dispatcher_plugin_nb2workflow.exposer import get_config_dict_from_kg
+
+    with caplog.at_level(logging.INFO):
+        cdict = get_config_dict_from_kg({"type": "file",
+                                         "path": "tests/example-kg.ttl",
+                                         "page_size": 2})
+    assert sorted(cdict['instruments']) == ['kgexample', 'kgprod', 'kgunlab']
+    assert 'KG query returned 3 rows in 2 pages' in caplog.text
+    assert 'kgexample-workflow-backend' not in caplog.text
+
+    cdict = get_config_dict_from_kg({"type": "file",
+                                     "path": "tests/example-kg.ttl",
+                                     "creativeWorkStatus": ["production", "undefined"]})
+    assert sorted(cdict['instruments']) == ['kgprod', 'kgunlab']
+
+def test_get_config_dict_from_kg_cached_graph(tmp_path):
+    from dispatcher_plugin_nb2workflow import exposer
+
+    kg_path = tmp_path / 'kg.ttl'
+    shutil.copy('tests/example-kg.ttl', kg_path)
+    kg_conf = {"type": "file", "path": str(kg_path), "cache_path": str(tmp_path / 'kg.pickle')}
+
+    cdict = exposer.get_config_dict_from_kg(kg_conf)
+    assert sorted(cdict['instruments']) == ['kgexample', 'kgprod', 'kgunlab']
+    assert cdict['instruments']['kgprod']['creativeWorkStatus'] == 'production'
+    assert (tmp_path / 'kg.pickle').exists()
+
+    # as in a new worker, the graph is loaded from the pickle
+    exposer._kg_graphs.clear()
+    assert exposer.get_config_dict_from_kg(kg_conf) == cdict
+
+    # the cached graph is not used once the file changes
+    with open(kg_path, 'a') as fd:
+        fd.write(dedent('''
+            <https://path.to/new.git> a oda:WorkflowService ;
+                oda:deployment_name "kgnew-workflow-backend" ;
+                oda:service_name "kgnew" .
+            '''))
+    exposer._kg_graphs.clear()
+    cdict = exposer.get_config_dict_from_kg(kg_conf)
+    assert sorted(cdict['instruments']) == ['kgexample', 'kgnew', 'kgprod', 'kgunlab']
+
 def test_external_service_kg(conf_file, dispatcher_live_fixture):
     with open(conf_file, 'r') as fd:
         conf_bk = fd.read()
@@ -1348,4 +1391,4 @@ def test_nonoptional_parameter_is_not_nullable(
 
     finally:
         with open(conf_file, 'w') as fd:
-            fd.write(conf_bk)
\ No newline at end of file
+            fd.write(conf_bk)
@@ -0,0 +1,190 @@
+import gzip
+import json
+import os
+
+import pytest
+import requests
+
+
+def test_api_passthrough_of_encoded_products(reload_plugin_conf, mock_backend):
+    from oda_api.data_products import ODAAstropyTable
+
+    with open('tests/responses/table.json', 'r') as fd:
+        table_output = json.loads(fd.read())['output']['output']
+    with open('tests/responses/image.json', 'r') as fd:
+        image_output = json.loads(fd.read())['output']['result']
+
+    server = reload_plugin_conf("""
+                                api_passthrough: true
+                                instruments:
+                                  example0:
+                                    data_server_url: http://localhost:8000
+                                    dummy_cache: ""
+                                """)
+
+    c = requests.get(server + "/run_analysis",
+                    params = {'instrument': 'example0',
+                              'query_status': 'new',
+                              'query_type': 'Real',
+                              'product_type': 'table',
+                              'api': 'True',
+                              'run_asynch': 'False'})
+    assert c.status_code == 200
+    assert c.json()['products']['astropy_table_product_ascii_list'][0] == table_output
+
+    # the requested table encoding applies to the forwarded tables too
+    c = requests.get(server + "/run_analysis",
+                    params = {'instrument': 'example0',
+                              'query_status': 'new',
+                              'query_type': 'Real',
+                              'product_type': 'table',
+                              'api': 'True',
+                              'run_asynch': 'False',
+                              '_api_table_encoding': 'binary'})
+    assert c.status_code == 200
+    products = c.json()['products']
+    assert products['astropy_table_product_ascii_list'] == []
+    table = ODAAstropyTable.decode(products['astropy_table_product_binary_list'][0], use_binary=True).table
+    assert table.colnames == ODAAstropyTable.decode(table_output).table.colnames
+
+    c = requests.get(server + "/run_analysis",
+                    params = {'instrument': 'example0',
+                              'query_status': 'new',
+                              'query_type': 'Real',
+                              'product_type': 'image',
+                              'api': 'True',
+                              'run_asynch': 'False'})
+    assert c.status_code == 200
+    numpy_data_product = c.json()['products']['numpy_data_product_list'][0]
+    assert numpy_data_product['data_unit_list'] == image_output['data_unit_list']
+
+
+@pytest.mark.parametrize('gzipped', [False, True])
+def test_streamed_numpy_data_product_decoding(gzipped, monkeypatch):
+    import base64
+    import pickle
+    import numpy as np
+    from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
+    from dispatcher_plugin_nb2workflow import decoding
+
+    # several chunks per array
+    monkeypatch.setattr(decoding, 'chunk_size', 4 * 1024)
+
+    image = np.random.random((100, 100))
+    rate = np.zeros(500, dtype=[('TIME', '<f8'), ('RATE', '<f8')])
+    rate['TIME'] = np.arange(500)
+    encoded = NumpyDataProduct([NumpyDataUnit(data=None, hdu_type='primary', name='PRIMARY'),
+                                NumpyDataUnit(data=image, hdu_type='image', name='IMAGE', data_header={'BUNIT': 'ct'}),
+                                NumpyDataUnit(data=rate, hdu_type='bintable', name='RATE', units_dict={'TIME': 'd'})],
+                               name='prod',
+                               meta_data={'src': 'Crab'}).encode()
+    if gzipped:
+        for enc_du in encoded['data_unit_list'][1:]:
+            enc_du['binarys'] = base64.b64encode(gzip.compress(pickle.dumps(pickle.loads(
+                base64.b64decode(enc_du['binarys']), encoding='bytes')))).decode()
+
+    decoded = decoding.decode_numpy_data_product(encoded)
+    assert decoded.name == 'prod'
+    assert decoded.meta_data == {'src': 'Crab'}
+    assert [du.name for du in decoded.data_unit] == ['PRIMARY', 'IMAGE', 'RATE']
+    assert decoded.data_unit[0].data is None
+    assert np.array_equal(decoded.data_unit[1].data, image)
+    assert decoded.data_unit[1].header == {'BUNIT': 'ct'}
+    assert np.array_equal(decoded.data_unit[2].data, rate)
+    assert decoded.data_unit[2].units_dict == {'TIME': 'd'}
+
+
+@pytest.mark.parametrize('separator', ['\n', '\r\n', ' '])
+def test_numpy_data_unit_decoding_with_whitespace(separator, monkeypatch):
+    import numpy as np
+    from oda_api.data_products import NumpyDataUnit
+    from dispatcher_plugin_nb2workflow import decoding
+
+    monkeypatch.setattr(decoding, 'chunk_size', 4 * 1024)
+
+    image = np.random.random((100, 100))
+    encoded = NumpyDataUnit(data=image, hdu_type='image', name='IMAGE').encode(use_pickle=True)
+    binarys = encoded['binarys']
+    encoded['binarys'] = separator.join(binarys[i:i + 76] for i in range(0, len(binarys), 76))
+
+    assert np.array_equal(decoding.decode_numpy_data_unit(encoded).data, image)
+
+
+def test_table_formats(tmp_path, reload_plugin_conf, mock_backend):
+    from astropy.table import Table
+    from oda_api.data_products import ODAAstropyTable
+    from dispatcher_plugin_nb2workflow.products import NB2WAstropyTableProduct
+
+    with open('tests/responses/table.json', 'r') as fd:
+        table_output = json.loads(fd.read())['output']['output']
+    ref_table = ODAAstropyTable.decode(table_output).table
+
+    product = NB2WAstropyTableProduct(table_output, out_dir=str(tmp_path), name='tab')
+    product.set_table_format('fits')
+    product.write()
+    assert product.file_path.endswith('tab.fits')
+    assert Table.read(product.file_path).colnames == ref_table.colnames
+
+    server = reload_plugin_conf("""
+                                instruments:
+                                  example0:
+                                    data_server_url: http://localhost:8000
+                                    dummy_cache: ""
+                                    api_table_encoding: binary
+                                """)
+
+    c = requests.get(server + "/run_analysis",
+                    params = {'instrument': 'example0',
+                              'query_status': 'new',
+                              'query_type': 'Real',
+                              'product_type': 'table',
+                              'api': 'True',
+                              'run_asynch': 'False'})
+    assert c.status_code == 200
+    products = c.json()['products']
+    assert products['astropy_table_product_ascii_list'] == []
+    table = ODAAstropyTable.decode(products['astropy_table_product_binary_list'][0], use_binary=True).table
+    assert table.colnames == ref_table.colnames
+    assert len(table) == len(ref_table)
+
+    # chosen by the request
+    c = requests.get(server + "/run_analysis",
+                    params = {'instrument': 'example0',
+                              'query_status': 'new',
+                              'query_type': 'Real',
+                              'product_type': 'table',
+                              'api': 'True',
+                              'run_asynch': 'False',
+                              '_api_table_encoding': 'ascii'})
+    assert c.status_code == 200
+    assert c.json()['products']['astropy_table_product_ascii_list'][0]['ascii'] == table_output['ascii']
+
+
+def test_tile_compressed_image_product(tmp_path):
+    from astropy.io import fits
+    import numpy as np
+    from dispatcher_plugin_nb2workflow.products import NB2WImageProduct
+
+    with open('tests/responses/image.json', 'r') as fd:
+        image_output = json.loads(fd.read())['output']['result']
+
+    plain = NB2WImageProduct(image_output, out_dir=str(tmp_path / 'plain'), name='image')
+    os.makedirs(plain.out_dir)
+    plain.write()
+
+    compressed = NB2WImageProduct(image_output, out_dir=str(tmp_path / 'compressed'), name='image')
+    os.makedirs(compressed.out_dir)
+    compressed.fits_compression = {'compression_type': 'RICE_1'}
+    compressed.write()
+
+    assert os.path.basename(compressed.file_path) == 'image.fits'
+    assert os.path.getsize(compressed.file_path) < os.path.getsize(plain.file_path)
+
+    with fits.open(plain.file_path) as plain_hdul, fits.open(compressed.file_path) as compressed_hdul:
+        assert len(compressed_hdul) == len(plain_hdul)
+        for plain_hdu, compressed_hdu in zip(plain_hdul, compressed_hdul):
+            assert compressed_hdu.name == plain_hdu.name
+            if isinstance(plain_hdu, fits.ImageHDU):
+                assert isinstance(compressed_hdu, fits.CompImageHDU)
+                # float images are not quantized by default
+                assert np.array_equal(compressed_hdu.data, plain_hdu.data)
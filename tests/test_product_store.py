@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+
+import pytest
+
+
+def test_content_addressed_product_store(tmp_path):
+    from dispatcher_plugin_nb2workflow.products import NB2WAstropyTableProduct
+    from dispatcher_plugin_nb2workflow.product_store import product_store
+
+    with open('tests/responses/table.json', 'r') as fd:
+        table_output = json.loads(fd.read())['output']['output']
+
+    product_store.configure({'path': str(tmp_path / 'store')})
+    try:
+        file_paths = []
+        for job in ['job0', 'job1']:
+            os.makedirs(tmp_path / job)
+            product, = NB2WAstropyTableProduct._init_as_list(table_output, out_dir=str(tmp_path / job), name='tab')
+            if job == 'job1':
+                def write():
+                    raise AssertionError('the stored product should have been linked')
+                product.write = write
+            product_store.write(product, options=['ecsv', None])
+            file_paths.append(product.file_path)
+
+        assert file_paths == [str(tmp_path / 'job0' / 'tab.ecsv'), str(tmp_path / 'job1' / 'tab.ecsv')]
+        assert os.path.samefile(*file_paths)
+        # the two jobs and the store
+        assert os.stat(file_paths[0]).st_nlink == 3
+
+        # other writing options give another file
+        os.makedirs(tmp_path / 'job2')
+        product, = NB2WAstropyTableProduct._init_as_list(table_output, out_dir=str(tmp_path / 'job2'), name='tab')
+        product.set_table_format('fits')
+        product_store.write(product, options=['fits', None])
+        assert product.file_path.endswith('tab.fits')
+
+        shutil.rmtree(tmp_path / 'job0')
+        assert product_store.cleanup() == 0
+        shutil.rmtree(tmp_path / 'job1')
+        shutil.rmtree(tmp_path / 'job2')
+        assert product_store.cleanup() == 2
+        assert os.listdir(tmp_path / 'store' / 'objects') == []
+        assert os.listdir(tmp_path / 'store' / 'index') == []
+    finally:
+        product_store.configure(None)
+
+
+def test_partial_products_reused(tmp_path):
+    from dispatcher_plugin_nb2workflow.products import NB2WProduct, NB2WAstropyTableProduct, decoded_products
+    from dispatcher_plugin_nb2workflow.product_store import payload_size
+
+    with open('tests/responses/table.json', 'r') as fd:
+        table_output = json.loads(fd.read())['output']['output']
+    output_descr = {'table': {'name': 'table',
+                              'owl_type': 'http://odahub.io/ontology#ODAAstropyTable',
+                              'python_type': {'type_object': "<class 'str'>"},
+                              'value': ''},
+                    'comment': {'name': 'comment',
+                                'owl_type': 'http://odahub.io/ontology#ODATextProduct',
+                                'python_type': {'type_object': "<class 'str'>"},
+                                'value': ''}}
+    scope = ('example0', 'partial-job', str(tmp_path))
+
+    # while the job is running, only the table is complete
+    partial_list = NB2WProduct.prod_list_factory(output_descr, {'table': table_output}, str(tmp_path),
+                                                 partial=True, cache_scope=scope)
+    assert [type(p) for p in partial_list] == [NB2WAstropyTableProduct]
+    assert decoded_products.has_scope(scope)
+
+    # a changed output is decoded again
+    changed_output = dict(table_output, name='other')
+    changed_list = NB2WProduct.prod_list_factory(output_descr, {'table': changed_output}, str(tmp_path),
+                                                 partial=True, cache_scope=scope)
+    assert changed_list[0] is not partial_list[0]
+
+    final_list = NB2WProduct.prod_list_factory(output_descr, {'table': changed_output, 'comment': 'done'},
+                                               str(tmp_path), cache_scope=scope)
+    assert final_list[0] is changed_list[0]
+    assert final_list[1].data_prod == 'done'
+    # released with the final result, which is not kept
+    assert not decoded_products.has_scope(scope)
+    assert decoded_products.size == 0
+
+    # bounded by the size of the outputs
+    max_bytes = decoded_products.max_bytes
+    decoded_products.max_bytes = payload_size(table_output) + 1
+    try:
+        for job in ['job0', 'job1']:
+            NB2WProduct.prod_list_factory(output_descr, {'table': table_output}, str(tmp_path),
+                                          partial=True, cache_scope=(job,))
+        assert not decoded_products.has_scope(('job0',))
+        assert decoded_products.has_scope(('job1',))
+    finally:
+        decoded_products.drop_scope(('job1',))
+        decoded_products.max_bytes = max_bytes
+
+    with pytest.raises(KeyError):
+        NB2WProduct.prod_list_factory(output_descr, {'table': table_output}, str(tmp_path))
+
+
+def test_partial_products_of_concurrent_scopes(tmp_path):
+    from dispatcher_plugin_nb2workflow.products import NB2WProduct, decoded_products
+
+    with open('tests/responses/table.json', 'r') as fd:
+        table_output = json.loads(fd.read())['output']['output']
+    output_descr = {'table': {'name': 'table',
+                              'owl_type': 'http://odahub.io/ontology#ODAAstropyTable',
+                              'python_type': {'type_object': "<class 'str'>"},
+                              'value': ''},
+                    'comment': {'name': 'comment',
+                                'owl_type': 'http://odahub.io/ontology#ODATextProduct',
+                                'python_type': {'type_object': "<class 'str'>"},
+                                'value': ''}}
+    # two requests following the same backend job
+    scope_dirs = {('example0', 'shared-job', str(tmp_path / d)): str(tmp_path / d) for d in ['a', 'b']}
+    (scope_a, dir_a), (scope_b, dir_b) = scope_dirs.items()
+
+    partial = {scope: NB2WProduct.prod_list_factory(output_descr, {'table': table_output}, out_dir,
+                                                    partial=True, cache_scope=scope)
+               for scope, out_dir in scope_dirs.items()}
+    assert partial[scope_a][0] is not partial[scope_b][0]
+    assert partial[scope_b][0].out_dir == dir_b
+
+    # the first request completing releases only its own products
+    final_a = NB2WProduct.prod_list_factory(output_descr, {'table': table_output, 'comment': 'done'},
+                                            dir_a, cache_scope=scope_a)
+    assert final_a[0] is partial[scope_a][0]
+    assert not decoded_products.has_scope(scope_a)
+    assert decoded_products.has_scope(scope_b)
+
+    # a poll of the first request still running is not kept
+    NB2WProduct.prod_list_factory(output_descr, {'table': table_output}, dir_a, partial=True, cache_scope=scope_a)
+    assert not decoded_products.has_scope(scope_a)
+
+    final_b = NB2WProduct.prod_list_factory(output_descr, {'table': table_output, 'comment': 'done'},
+                                            dir_b, cache_scope=scope_b)
+    assert final_b[0] is partial[scope_b][0]
+    assert not decoded_products.has_scope(scope_b)
+
+
+def test_payload_digest_without_copy():
+    import tracemalloc
+    from dispatcher_plugin_nb2workflow.product_store import payload_digest
+
+    binarys = 'A' * (64 << 20)
+    payload = {'name': 'image', 'data_unit_list': [{'binarys': binarys, 'meta_data': {'a': 1, 'b': [None]}}]}
+    reordered = {'data_unit_list': [{'meta_data': {'b': [None], 'a': 1}, 'binarys': binarys}], 'name': 'image'}
+
+    tracemalloc.start()
+    try:
+        digest = payload_digest(payload)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert peak < len(binarys) / 10
+    assert payload_digest(reordered) == digest
+    assert payload_digest(dict(payload, name='other')) != digest
+    assert payload_digest({'a': '1'}) != payload_digest({'a': 1})
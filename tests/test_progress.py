@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize('output_key', ['partial_output', 'output'])
+def test_progress_partial_output(httpserver, output_key):
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/lightcurve').respond_with_json(
+        {'workflow_status': 'started', 'comment': '', 'jobdir': '/tmp/nb2w-partial', output_key: {'lc': 'done'}})
+    httpserver.expect_request('/trace/nb2w-partial/lightcurve').respond_with_data('<html/>')
+
+    res_trace_dict, query_out = NB2WDataDispatcher(instrument='example0').get_progress_run(
+        run_asynch=True,
+        call_back_url='http://localhost/callback',
+        task='lightcurve',
+        param_dict={'par': output_key})
+    assert query_out.get_job_status() == 'progress'
+    # only the outputs which the backend reports as complete are delivered with the progress
+    if output_key == 'partial_output':
+        assert res_trace_dict['partial_output'] == {'lc': 'done'}
+    else:
+        assert 'partial_output' not in res_trace_dict
+
+
+def test_compact_progress_cells():
+    from dispatcher_plugin_nb2workflow.progress import ProgressCompactor
+
+    with open(os.path.join(os.path.dirname(__file__), 'responses', 'test_output.html'), 'r') as fd:
+        test_output_html = fd.read()
+
+    compactor = ProgressCompactor()
+    progress = compactor.compact(test_output_html, job_key=('example0', 'nb2w-ylp5ovnm'))
+    assert len(json.dumps(progress)) < len(test_output_html) / 100
+    first, gather = progress['cells']
+    assert first['id'] == '43a2423b'
+    assert first['status'] == 'completed'
+    assert first['execution_count'] == 1
+    assert first['output'] == 'test'
+    assert 'completed_at' in first
+    assert gather['status'] == 'pending'
+    assert gather['tags'] == ['injected-gather-outputs']
+
+    # reused while the trace is unchanged
+    assert compactor.compact(test_output_html, job_key=('example0', 'nb2w-ylp5ovnm')) is progress
+
+    long_output = test_output_html.replace('<pre>test\n', '<pre>' + 'x' * 1000 + 'end\n')
+    progress = compactor.compact(long_output, job_key=('example0', 'nb2w-ylp5ovnm'), output_chars=10)
+    assert progress['cells'][0]['output'] == 'xxxxxxxend'
+    assert progress['cells'][0]['output_truncated']
+
+    # the outputs are dropped first, then the earliest cells
+    progress = compactor.compact(long_output, job_key=('example0', 'nb2w-ylp5ovnm'), max_size=500)
+    assert progress['omitted_cells'] == 0
+    assert progress['cells'][0]['output'] == ''
+    assert len(json.dumps(progress)) <= 500
+    progress = compactor.compact(long_output, job_key=('example0', 'nb2w-ylp5ovnm'), max_size=300)
+    assert progress['omitted_cells'] == 1
+    assert [cell['index'] for cell in progress['cells']] == [1]
@@ -0,0 +1,62 @@
+import os
+
+
+def test_replica_affinity_shared_by_workers(tmp_path):
+    from dispatcher_plugin_nb2workflow.replicas import ReplicaPool
+    from dispatcher_plugin_nb2workflow.shared_store import shared_store
+
+    urls = ['http://replica0:9393', 'http://replica1:9393']
+    shared_store.configure({'path': str(tmp_path / 'shared.sqlite')})
+    try:
+        # the pools of two dispatcher workers
+        worker0, worker1 = ReplicaPool('replicated', urls), ReplicaPool('replicated', urls)
+        worker0.bind('job-key', worker0.replicas[1])
+        worker0.alias(('jobdir', 'nb2w-job'), 'job-key')
+
+        # the other worker would otherwise choose the least loaded replica
+        worker1.replicas[1].outstanding = 5
+        assert worker1.choose('job-key').url == 'http://replica1:9393'
+        assert worker1.choose(('jobdir', 'nb2w-job')).url == 'http://replica1:9393'
+        assert worker1.choose('other-job').url == 'http://replica0:9393'
+    finally:
+        shared_store.configure(None)
+
+
+def test_backend_replicas_failover_and_affinity(httpserver):
+    from pytest_httpserver import HTTPServer
+    from cdci_data_analysis.configurer import DataServerConf
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+
+    with open(os.path.join(os.path.dirname(__file__), 'responses', 'test_output.html'), 'r') as fd:
+        trace_html = fd.read()
+
+    other_replica = HTTPServer(port=0)
+    other_replica.start()
+    try:
+        for server in [httpserver, other_replica]:
+            server.expect_request('/api/v1.0/options').respond_with_json({})
+            server.expect_request('/api/v1.0/get/lightcurve').respond_with_json(
+                {'workflow_status': 'started', 'comment': '', 'jobdir': '/tmp/nb2w-replica'})
+            server.expect_request('/trace/nb2w-replica/lightcurve').respond_with_data(trace_html)
+
+        config = DataServerConf.from_conf_dict({'data_server_url': ['http://localhost:1', # nothing listening
+                                                                    httpserver.url_for('/'),
+                                                                    other_replica.url_for('/')],
+                                                'dummy_cache': ''})
+        dispatcher = NB2WDataDispatcher(instrument='replicated', config=config)
+        res_trace_dict, query_out = dispatcher.get_progress_run(run_asynch=True,
+                                                                call_back_url='http://localhost/callback',
+                                                                task='lightcurve',
+                                                                param_dict={'par': 1})
+        assert query_out.get_job_status() == 'progress'
+        assert res_trace_dict['res'].text == trace_html
+
+        # the unreachable replica is skipped, the job and its trace are served by a single replica
+        paths = {'httpserver': [req.path for req, _ in httpserver.log],
+                 'other_replica': [req.path for req, _ in other_replica.log]}
+        serving = [name for name, p in paths.items() if p]
+        assert len(serving) == 1
+        assert paths[serving[0]] == ['/api/v1.0/get/lightcurve', '/trace/nb2w-replica/lightcurve']
+    finally:
+        other_replica.clear()
+        other_replica.stop()
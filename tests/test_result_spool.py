@@ -0,0 +1,62 @@
+import json
+import os
+
+from werkzeug.wrappers import Response
+
+
+def test_async_result_read_from_spool(httpserver, monkeypatch, tmp_path):
+    from dispatcher_plugin_nb2workflow import exposer
+    from dispatcher_plugin_nb2workflow.dataserver_dispatcher import NB2WDataDispatcher
+    from dispatcher_plugin_nb2workflow.util import response_json
+
+    monkeypatch.setitem(exposer.static_config_dict, 'result_spool', {'path': str(tmp_path)})
+
+    backend_calls = []
+    def handler(request):
+        backend_calls.append(request.args.to_dict())
+        return Response(json.dumps({'workflow_status': 'started', 'jobdir': '/tmp/nb2w-spooled', 'comment': ''}),
+                        status=201,
+                        content_type='application/json')
+
+    httpserver.expect_request('/api/v1.0/options').respond_with_json({})
+    httpserver.expect_request('/api/v1.0/get/lc').respond_with_handler(handler)
+
+    def run_query():
+        return NB2WDataDispatcher(instrument='example0').run_query(call_back_url='http://dispatcher/call_back',
+                                                                   task='lc',
+                                                                   param_dict={'src_name': 'Crab'})
+
+    _, query_out = run_query()
+    assert query_out.get_job_status() != 'done'
+    assert len(backend_calls) == 1
+
+    # the backend completed the job, and notified the dispatcher
+    os.makedirs(tmp_path / 'nb2w-spooled')
+    with open(tmp_path / 'nb2w-spooled' / 'result.json', 'w') as fd:
+        json.dump({'exceptions': [], 'jobdir': '/tmp/nb2w-spooled', 'output': {'result': 42}}, fd)
+
+    res, query_out = run_query()
+    assert query_out.get_job_status() == 'done'
+    assert len(backend_calls) == 1
+    assert response_json(res)['data']['output'] == {'result': 42}
+
+
+def test_spooled_result_path_within_spool(tmp_path):
+    from dispatcher_plugin_nb2workflow.result_spool import ResultSpool
+
+    spool_conf = {'path': str(tmp_path / 'spool')}
+    for jobdir in ['spool/nb2w-job', 'outside']:
+        os.makedirs(tmp_path / jobdir)
+        with open(tmp_path / jobdir / 'result.json', 'w') as fd:
+            json.dump({'output': {}}, fd)
+    with open(tmp_path / 'result.json', 'w') as fd:
+        json.dump({'output': {}}, fd)
+    os.symlink(tmp_path / 'outside', tmp_path / 'spool' / 'nb2w-link')
+
+    spool = ResultSpool()
+    for key, jobdir in [('job', '/tmp/nb2w-job'), ('parent', '..'), ('current', '.'), ('link', 'nb2w-link')]:
+        spool.remember(key, jobdir)
+
+    assert spool.read(spool_conf, 'job').status_code == 200
+    for key in ['parent', 'current', 'link']:
+        assert spool.read(spool_conf, key) is None
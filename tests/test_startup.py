@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+from textwrap import dedent
+
+logger = logging.getLogger(__name__)
+
+
+def test_plugin_import_time_budget(tmp_path):
+    # the KG is unreachable, so the import would fail if it was queried
+    conf = tmp_path / 'plugin_conf.yml'
+    conf.write_text(dedent("""
+                           kg:
+                             type: query-service
+                             path: http://127.0.0.1:9/unreachable
+                           instruments:
+                             example0:
+                               data_server_url: http://localhost:8000
+                               dummy_cache: ""
+                           """))
+    code = dedent("""
+                  import builtins, json, sys, time
+                  import dispatcher_plugin_nb2workflow
+                  package_modules = [m for m in ['astropy.io.fits', 'oda_api.data_products'] if m in sys.modules]
+                  # these are imported by the dispatcher anyway, astropy.io.fits with them
+                  import cdci_data_analysis.analysis.instrument
+                  import cdci_data_analysis.analysis.queries
+                  import cdci_data_analysis.analysis.products
+                  import cdci_data_analysis.configurer
+
+                  # modules imported by the plugin itself, even if they are already loaded
+                  plugin_imports = set()
+                  _import = builtins.__import__
+                  def tracking_import(name, globals=None, locals=None, fromlist=(), level=0):
+                      if level == 0 and (globals or {}).get('__name__', '').startswith('dispatcher_plugin_nb2workflow'):
+                          plugin_imports.update([name] + [f'{name}.{x}' for x in fromlist or ()])
+                      return _import(name, globals, locals, fromlist, level)
+                  builtins.__import__ = tracking_import
+
+                  t0 = time.perf_counter()
+                  import dispatcher_plugin_nb2workflow.exposer as exposer
+                  import_time = time.perf_counter() - t0
+                  builtins.__import__ = _import
+                  print(json.dumps({'import_time': import_time,
+                                    'kg_queried': exposer.combined_instrument_dict_built,
+                                    'package_modules': package_modules,
+                                    'eager_modules': [m for m in ['magic'] if m in sys.modules] +
+                                                     [m for m in ['astropy.io.fits', 'oda_api.data_products'] 
+                                                      if m in plugin_imports]}))
+                  """)
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  env=dict(os.environ, CDCI_NB2W_PLUGIN_CONF_FILE=str(conf)))
+    result = json.loads(out.decode().strip().splitlines()[-1])
+    logger.info('plugin import: %s', result)
+
+    assert not result['kg_queried']
+    assert result['package_modules'] == []
+    assert result['eager_modules'] == []
+    assert result['import_time'] < float(os.environ.get('NB2W_IMPORT_TIME_BUDGET', 0.5))
+
+
+def test_plugin_importer_path_queries_kg_once(tmp_path):
+    conf = tmp_path / 'plugin_conf.yml'
+    conf.write_text(dedent("""
+                           kg:
+                             type: query-service
+                             path: http://127.0.0.1:9/unreachable
+                           instruments:
+                             example0:
+                               data_server_url: http://localhost:8000
+                               dummy_cache: ""
+                             example1:
+                               data_server_url: http://localhost:8001
+                               dummy_cache: ""
+                           """))
+    code = dedent("""
+                  import json
+                  import dispatcher_plugin_nb2workflow.exposer as exposer
+                  kg_queries = []
+                  def get_config_dict_from_kg(kg_conf_dict=exposer.static_config_dict['kg']):
+                      kg_queries.append(kg_conf_dict)
+                      return {'instruments': {}}
+                  exposer.get_config_dict_from_kg = get_config_dict_from_kg
+                  # as cdci_data_analysis.plugins.importer does
+                  instrument_factory_list = []
+                  instrument_factory_list.extend(exposer.instr_factory_list)
+                  exposer.get_combined_instrument_dict()
+                  exposer.get_instrument_option('example0', 'api_passthrough')
+                  print(json.dumps({'kg_queries': len(kg_queries),
+                                    'instruments': [f.instr_name for f in instrument_factory_list]}))
+                  """)
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  env=dict(os.environ, CDCI_NB2W_PLUGIN_CONF_FILE=str(conf)))
+    result = json.loads(out.decode().strip().splitlines()[-1])
+
+    assert result == {'kg_queries': 1, 'instruments': ['example0', 'example1']}